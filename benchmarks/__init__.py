@@ -0,0 +1,4 @@
+"""
+Package: benchmarks
+Performance benchmarks of the shopcart service
+"""
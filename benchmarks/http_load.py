@@ -0,0 +1,212 @@
+"""
+HTTP load test of the shopcart service
+
+Seeds N customers with M items each through the batch add-to-cart
+endpoint, then drives a mix of concurrent browse, add, update and
+checkout traffic for a fixed time and prints throughput and latency
+percentiles per endpoint as JSON, so that runs can be compared across
+commits.
+
+Run it against a service it starts itself on a fresh SQLite file:
+  python -m benchmarks.http_load --customers 200 --items 20 --concurrency 16
+
+or against a server that is already running, for example under gunicorn
+with Postgres, using customer ids that no other run used:
+  python -m benchmarks.http_load --base-url http://localhost:5000 --first-customer 100000
+"""
+import os
+import sys
+import json
+import time
+import logging
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+import requests
+from tests.factories import ShopcartFactory
+
+# (name, method, path, weight) of the traffic mix
+OPERATIONS = [
+    ("browse_cart", "GET", "/api/shopcarts/{customer_id}", 45),
+    ("read_product", "GET", "/api/shopcarts/{customer_id}/products/{product_id}", 20),
+    ("add_product", "POST", "/api/shopcarts/{customer_id}/products/?merge=true", 15),
+    ("update_quantity", "PATCH", "/api/shopcarts/{customer_id}/products/{product_id}", 10),
+    ("summary", "GET", "/api/shopcarts/{customer_id}/summary", 5),
+    ("checkout", "PUT", "/api/shopcarts/{customer_id}/checkout", 5),
+]
+
+
+######################################################################
+#  S E R V E R
+######################################################################
+def start_local_server(database_uri):
+    """ Serves the app from a thread of this process and returns its base URL """
+    from werkzeug.serving import make_server
+    from services import app
+    from services.routes import init_db
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
+    init_db()
+    app.logger.setLevel(logging.ERROR)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}".format(server.server_port)
+
+
+def seed(base_url, first_customer, customers, items):
+    """ Fills the shopcarts of the benchmark customers, one batch request per customer """
+    session = requests.Session()
+    for customer_id in range(first_customer, first_customer + customers):
+        batch = [
+            ShopcartFactory(customer_id=customer_id, product_id=product_id).serialize()
+            for product_id in range(1, items + 1)
+        ]
+        resp = session.post("{}/api/shopcarts/{}/products/".format(base_url, customer_id), json=batch)
+        resp.raise_for_status()
+
+
+######################################################################
+#  L O A D
+######################################################################
+def run_client(base_url, args, deadline, samples, seed_value):
+    """ Sends requests from the traffic mix until the deadline and records their latency """
+    rnd = random.Random(seed_value)
+    session = requests.Session()
+    weights = [operation[3] for operation in OPERATIONS]
+    while time.perf_counter() < deadline:
+        name, method, path, _ = rnd.choices(OPERATIONS, weights)[0]
+        customer_id = rnd.randrange(args.first_customer, args.first_customer + args.customers)
+        product_id = rnd.randint(1, args.items)
+        url = base_url + path.format(customer_id=customer_id, product_id=product_id)
+        body = None
+        if name == "add_product":
+            body = ShopcartFactory(customer_id=customer_id, product_id=product_id, quantity=1).serialize()
+        elif name == "update_quantity":
+            body = {"delta": rnd.choice([1, 1, -1])}
+        start = time.perf_counter()
+        try:
+            code = session.request(method, url, json=body).status_code
+        except requests.RequestException:
+            code = None
+        samples.append((name, code, time.perf_counter() - start))
+
+
+def percentile(values, fraction):
+    """ Returns the nearest-rank percentile of sorted values """
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))], 3)
+
+
+def summarize(samples, elapsed):
+    """ Returns the throughput and latency of every operation of the mix """
+    endpoints = {}
+    for name, method, path, _ in OPERATIONS:
+        mine = [sample for sample in samples if sample[0] == name]
+        latencies = sorted(sample[2] * 1000 for sample in mine)
+        codes = {}
+        for sample in mine:
+            codes[str(sample[1])] = codes.get(str(sample[1]), 0) + 1
+        endpoints[name] = {
+            "method": method,
+            "path": path,
+            "requests": len(mine),
+            "errors": sum(1 for sample in mine if sample[1] is None or sample[1] >= 500),
+            "status_codes": codes,
+            "throughput_rps": round(len(mine) / elapsed, 2),
+            "latency_ms": {
+                "mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": round(latencies[-1], 3) if latencies else None,
+            },
+        }
+    return endpoints
+
+
+def git_commit():
+    """ Returns the commit under test, if this is a git checkout """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+######################################################################
+#  M A I N
+######################################################################
+def parse_args(argv):
+    """ Reads the options of the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", help="URL of a running service, by default one is started in-process")
+    parser.add_argument("--database-uri", help="database of the in-process service, by default a new SQLite file")
+    parser.add_argument("--customers", type=int, default=100, help="number of shopcarts to seed")
+    parser.add_argument("--items", type=int, default=10, help="number of items in each shopcart")
+    parser.add_argument("--first-customer", type=int, default=1, help="customer_id of the first seeded shopcart")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of traffic")
+    parser.add_argument("--label", help="free text recorded with the results, such as the worker model")
+    parser.add_argument("--output", help="file to write the JSON results to, by default stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """ Runs the benchmark and writes its results """
+    args = parse_args(argv)
+    base_url = args.base_url
+    database_uri = args.database_uri
+    if not base_url:
+        if not database_uri:
+            database_uri = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "http_load.db")
+        base_url = start_local_server(database_uri)
+
+    seed(base_url, args.first_customer, args.customers, args.items)
+
+    samples = []
+    deadline = time.perf_counter() + args.duration
+    clients = [
+        threading.Thread(target=run_client, args=(base_url, args, deadline, samples, number))
+        for number in range(args.concurrency)
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    results = {
+        "benchmark": "http_load",
+        "label": args.label,
+        "commit": git_commit(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "base_url": base_url,
+        "database": database_uri.split(":", 1)[0] if database_uri else None,
+        "parameters": {
+            "customers": args.customers,
+            "items": args.items,
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+        },
+        "total": {
+            "requests": len(samples),
+            "errors": sum(1 for sample in samples if sample[1] is None or sample[1] >= 500),
+            "throughput_rps": round(len(samples) / elapsed, 2),
+        },
+        "endpoints": summarize(samples, elapsed),
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,62 @@
+import os
 import logging
 SECRET_KEY = 'secret-for-dev'
 LOGGING_LEVEL = logging.INFO
+
+# Database and the connection pool of each worker
+SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URI", "sqlite://")
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "yes")
+
+# Read replicas that the SELECTs of GET requests run on, comma separated,
+# and the seconds a customer reads from the primary after a change
+DATABASE_REPLICA_URIS = [uri for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri]
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
+# Create the missing tables and run the migrations as every worker boots,
+# production turns this off and runs `flask db-init` once per deploy
+DB_CREATE_SCHEMA = os.getenv("DB_CREATE_SCHEMA", "true").lower() in ("true", "1", "yes")
+
+# Keyset pagination of GET /api/shopcarts
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Rows fetched per round trip by GET /api/shopcarts/export
+EXPORT_BATCH_SIZE = 1000
+
+# Per-worker LRU cache of serialized shopcarts, the TTL bounds how stale
+# a cart changed by another worker can be
+CART_CACHE_ENABLED = os.getenv("CART_CACHE_ENABLED", "false").lower() in ("true", "1", "yes")
+CART_CACHE_SIZE = int(os.getenv("CART_CACHE_SIZE", "1024"))
+CART_CACHE_TTL = float(os.getenv("CART_CACHE_TTL", "5"))
+
+# Requests running more SQL statements than this are logged
+QUERY_COUNT_WARN_THRESHOLD = int(os.getenv("QUERY_COUNT_WARN_THRESHOLD", "10"))
+
+# Library that dumps the JSON of list responses: auto, orjson or json
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto")
+
+# Write-behind buffering of quantity changes, written every interval
+# seconds or as soon as max pending items are waiting
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() in ("true", "1", "yes")
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "0.5"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "1000"))
+
+# Seconds an Idempotency-Key and the response stored with it are kept
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+
+# Seconds after which a retry takes over the Idempotency-Key of a request
+# that never completed, about the time a worker gets before it is killed
+IDEMPOTENCY_KEY_LEASE = int(os.getenv("IDEMPOTENCY_KEY_LEASE", os.getenv("GUNICORN_TIMEOUT", "30")))
+
+# Compression of responses of at least COMPRESSION_MIN_SIZE bytes, with
+# gzip at COMPRESSION_LEVEL, or Brotli and Zstandard when they are installed
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() in ("true", "1", "yes")
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+COMPRESSION_BROTLI_LEVEL = int(os.getenv("COMPRESSION_BROTLI_LEVEL", "4"))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
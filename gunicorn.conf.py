@@ -0,0 +1,85 @@
+"""
+Gunicorn settings of the service, read from the environment
+
+  gunicorn --config gunicorn.conf.py
+
+GUNICORN_WORKER_CLASS picks the worker model:
+
+  sync     one request at a time per worker process, the default
+  gthread  GUNICORN_THREADS requests at a time per worker process
+  gevent   GUNICORN_WORKER_CONNECTIONS greenlets per worker process, served
+           from services.green so that psycopg2 yields while it waits
+
+The number of workers follows the CPU count unless GUNICORN_WORKERS is
+set. Workers are replaced after about GUNICORN_MAX_REQUESTS requests, at
+staggered times, so that memory they leak or fragment is given back.
+"""
+import os
+import sys
+import shutil
+import multiprocessing
+
+WORKER_CLASSES = ("sync", "gthread", "gevent")
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+if worker_class not in WORKER_CLASSES:
+    raise ValueError("GUNICORN_WORKER_CLASS must be one of {}, not {}".format(", ".join(WORKER_CLASSES), worker_class))
+
+cpus = multiprocessing.cpu_count()
+
+# A sync worker waits on the database with the CPU idle, so there are more
+# of them than CPUs, while threads and greenlets fill that wait themselves
+DEFAULT_WORKERS = {"sync": 2 * cpus + 1, "gthread": cpus + 1, "gevent": cpus}
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:{}".format(os.getenv("PORT", "8080")))
+workers = int(os.getenv("GUNICORN_WORKERS", str(DEFAULT_WORKERS[worker_class])))
+threads = int(os.getenv("GUNICORN_THREADS", "4")) if worker_class == "gthread" else 1
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+wsgi_app = "services.green:app" if worker_class == "gevent" else "services:app"
+
+# Recycle workers, jittered so they do not all restart at once
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", str(max_requests // 10)))
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+# Importing the app once in the master shares its memory with the workers
+# and boots them faster. gevent must patch the standard library before the
+# app is imported, which only happens in the worker, so it never preloads
+preload_app = worker_class != "gevent" and os.getenv("GUNICORN_PRELOAD", "true").lower() in ("true", "1", "yes")
+
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+accesslog = os.getenv("GUNICORN_ACCESS_LOG") or None
+
+# Directory of the metrics that the workers share, see services/metrics.py
+metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.getenv("prometheus_multiproc_dir")
+
+
+def on_starting(server):
+    """ Empties the directory of the metrics of every worker left by the last run """
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+
+def post_fork(server, worker):
+    """ Drops the database connections the worker inherited from the master """
+    if "services.models" in sys.modules:
+        from services.models import dispose_engine
+        dispose_engine()
+
+
+def worker_exit(server, worker):
+    """ Writes the quantity changes the worker still buffers """
+    if "services.models" in sys.modules:
+        from services.models import quantity_buffer
+        quantity_buffer.close()
+
+
+def child_exit(server, worker):
+    """ Drops the live metrics of a worker that exited """
+    if metrics_dir:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -14,7 +14,7 @@ app = Flask(__name__)
 app.config.from_object("config")
 
 # Import the routes After the Flask app is created
-from services import routes, models
+from services import routes, models, metrics
 
 # Set up logging for production
 if __name__ != "__main__":
@@ -35,7 +35,7 @@ app.logger.info("  M Y   S E R V I C E   R U N N I N G  ".center(70, "*"))
 app.logger.info(70 * "*")
 
 try:
-    routes.init_db()  # make our sqlalchemy tables
+    routes.init_db()  # connect to the database, and make the tables unless DB_CREATE_SCHEMA is off
 except Exception as error:
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
@@ -0,0 +1,106 @@
+"""
+In-process cache of serialized shopcarts
+
+Each worker keeps its own bounded LRU cache keyed by customer_id. Entries
+expire after a time-to-live, which bounds how long a worker can serve a
+cart that another worker has changed. Writes in this worker invalidate
+the entry right away.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+def _key(customer_id):
+    """ Returns the key of a customer_id, the same for 7, "7" and "007" """
+    try:
+        return str(int(customer_id))
+    except (TypeError, ValueError):
+        return str(customer_id)
+
+
+class CartCache:
+    """
+    A bounded LRU cache with a time-to-live
+    The values are shared between callers and must not be modified
+    """
+
+    def __init__(self, enabled=False, maxsize=1024, ttl=5.0, clock=time.monotonic):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._clock = clock
+        self._invalidations = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.configure(enabled, maxsize, ttl)
+
+    def configure(self, enabled, maxsize, ttl):
+        """ Changes the settings of the cache and empties it """
+        self.enabled = enabled
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clear()
+
+    def token(self):
+        """ Returns a token to pass to put() once the value has been read """
+        return self._invalidations
+
+    def get(self, key):
+        """ Returns the value cached for a key, or None """
+        if not self.enabled:
+            return None
+        key = _key(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, token):
+        """
+        Caches a value for a key
+        The value is dropped if anything was invalidated since token() was
+        called, because it may have been read before that write committed
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if token != self._invalidations:
+                return
+            key = _key(key)
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """ Removes the value cached for a key """
+        with self._lock:
+            self._invalidations += 1
+            self._entries.pop(_key(key), None)
+
+    def clear(self):
+        """ Removes every value and resets the counters """
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """ Returns the counters and settings of the cache """
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
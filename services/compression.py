@@ -0,0 +1,226 @@
+"""
+Compression of the responses of the service
+
+Responses are compressed with the best encoding that both the client, in
+Accept-Encoding, and the server support: Brotli and Zstandard when the
+brotli and zstandard packages are installed, and gzip always. Responses
+smaller than COMPRESSION_MIN_SIZE are sent as they are, since compressing
+them costs more than it saves. Streamed responses, such as the export, are
+compressed chunk by chunk as they are sent.
+
+A compressed response has its own strong ETag, the ETag of the plain
+response with the encoding appended, as its bytes differ.
+
+Static files are never compressed on the fly. `flask precompress` writes a
+compressed copy next to each of them once, and a request for a static
+file is answered with the copy that the client accepts.
+"""
+import os
+import zlib
+import mimetypes
+import click
+from flask import request, send_from_directory
+from werkzeug.security import safe_join
+
+# Import Flask application
+from . import app
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# Media types worth compressing, anything else is usually compressed already
+COMPRESSIBLE_TYPES = {
+    "application/json", "application/x-ndjson", "application/javascript", "application/xml", "image/svg+xml",
+}
+
+# Static files that `flask precompress` compresses
+COMPRESSIBLE_EXTENSIONS = {".html", ".css", ".js", ".json", ".svg", ".txt", ".map", ".xml", ".ico"}
+
+
+class GzipCompressor:
+    """ Streaming gzip """
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        """ Compresses a chunk and returns all the output so far """
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """ Returns the end of the stream """
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    """ Streaming Brotli """
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        """ Compresses a chunk and returns all the output so far """
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        """ Returns the end of the stream """
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+    """ Streaming Zstandard """
+
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        """ Compresses a chunk and returns all the output so far """
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        """ Returns the end of the stream """
+        return self._compressor.flush()
+
+
+# (encoding, compressor, level setting, file extension) in order of preference
+ENCODINGS = [
+    encoding for encoding in [
+        ("br", BrotliCompressor, "COMPRESSION_BROTLI_LEVEL", ".br") if brotli else None,
+        ("zstd", ZstdCompressor, "COMPRESSION_ZSTD_LEVEL", ".zst") if zstandard else None,
+        ("gzip", GzipCompressor, "COMPRESSION_LEVEL", ".gz"),
+    ] if encoding
+]
+
+
+def negotiate(encodings=None):
+    """ Returns the encoding the client prefers among encodings, or None for none at all """
+    best, best_quality = None, 0
+    for encoding in encodings or [encoding[0] for encoding in ENCODINGS]:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def etag_variants(etag):
+    """ Returns the ETags of the plain and of every compressed form of a representation """
+    return [etag] + ["{}-{}".format(etag, encoding[0]) for encoding in ENCODINGS]
+
+
+def _compressor(encoding):
+    for name, compressor, level, _ in ENCODINGS:
+        if name == encoding:
+            return compressor(app.config[level])
+    raise ValueError("Unknown encoding: {}".format(encoding))
+
+
+def _stream(chunks, compressor):
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+######################################################################
+#  R E S P O N S E   H O O K
+######################################################################
+@app.after_request
+def compress_response(response):
+    """ Compresses the response with the encoding the client prefers """
+    if not app.config["COMPRESSION_ENABLED"]:
+        return response
+    if response.status_code == 304:
+        # point the client at the ETag of the form it already holds
+        etag = response.get_etag()[0]
+        for variant in (etag_variants(etag)[1:] if etag else []):
+            if variant in request.if_none_match:
+                response.set_etag(variant)
+        return response
+    mimetype = response.mimetype or ""
+    if mimetype not in COMPRESSIBLE_TYPES and not mimetype.startswith("text/"):
+        return response
+    response.vary.add("Accept-Encoding")
+    if (response.status_code < 200 or response.status_code == 204 or response.direct_passthrough
+            or "Content-Encoding" in response.headers or request.method == "HEAD"):
+        return response
+    if not response.is_streamed and response.calculate_content_length() < app.config["COMPRESSION_MIN_SIZE"]:
+        return response
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    compressor = _compressor(encoding)
+    if response.is_streamed:
+        response.response = _stream(response.response, compressor)
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(compressor.compress(response.get_data()) + compressor.finish())
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag("{}-{}".format(etag, encoding))
+    return response
+
+
+######################################################################
+#  S T A T I C   F I L E S
+######################################################################
+def send_static_file(filename):
+    """ Sends a static file, or the precompressed copy of it that the client accepts """
+    path = safe_join(app.static_folder, filename)
+    available = [
+        (name, extension) for name, _, _, extension in ENCODINGS
+        if path and os.path.isfile(path + extension)
+    ]
+    encoding = negotiate([name for name, _ in available]) if available else None
+    if encoding is None:
+        response = app.send_static_file(filename)
+    else:
+        extension = dict(available)[encoding]
+        response = send_from_directory(app.static_folder, filename + extension,
+                                       cache_timeout=app.get_send_file_max_age(filename))
+        response.mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        response.headers["Content-Encoding"] = encoding
+    if available:
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+app.view_functions["static"] = send_static_file
+
+
+@app.cli.command("precompress")
+@click.option("--directory", help="folder of the files, by default the static folder of the app")
+def precompress(directory):
+    """ Writes a compressed copy of every static file with every encoding """
+    directory = directory or app.static_folder
+    count = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.splitext(name)[1] not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            with open(path, "rb") as source:
+                data = source.read()
+            if len(data) < app.config["COMPRESSION_MIN_SIZE"]:
+                continue
+            for encoding, compressor, _, extension in ENCODINGS:
+                target = path + extension
+                if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                    continue
+                # compressed once, so the best ratio is worth its time
+                level = {"br": 11, "zstd": 19, "gzip": 9}[encoding]
+                compressed = compressor(level)
+                with open(target, "wb") as output:
+                    output.write(compressed.compress(data) + compressed.finish())
+                count += 1
+    click.echo("Compressed {} files".format(count))
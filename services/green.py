@@ -0,0 +1,27 @@
+"""
+Cooperative (gevent) entry point of the service
+
+Serve the app from this module with gevent workers so that a request that
+waits on Postgres costs a greenlet instead of a whole worker process:
+
+  gunicorn --worker-class gevent --worker-connections 1000 services.green:app
+
+The standard library is monkey patched before anything else is imported,
+and psycopg2, which talks to Postgres in C, is made to yield to the other
+greenlets while it waits on the network. The REST API and the swagger
+documentation are those of services:app, unchanged.
+
+Greenlets share the connection pool of their worker. Requests beyond
+DB_POOL_SIZE + DB_MAX_OVERFLOW queue for a connection for up to
+DB_POOL_TIMEOUT seconds, so many idle clients cost little while the
+number of Postgres connections stays bounded.
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg  # noqa: E402
+
+patch_psycopg()
+
+from services import app  # noqa: E402,F401
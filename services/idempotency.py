@@ -0,0 +1,71 @@
+"""
+Idempotent retries of mutating requests
+
+An API gateway retries a POST or a PUT that timed out, although the first
+attempt may have gone through. A client that sends an Idempotency-Key
+header gets the response of the first attempt back for every retry with
+the same key, and the request does not run again.
+
+The first request claims its key in the idempotency_key table before it
+runs and stores its response there when it succeeds, in the transaction
+that commits its changes, so a retry finds it whichever worker answers.
+The key remembers a fingerprint of the request and reusing it for a
+different request is refused. A retry that arrives while the first attempt
+is still running is refused too, unless the claim is older than
+IDEMPOTENCY_KEY_LEASE seconds: the first attempt died without committing
+anything, and the retry takes the key over. A request that fails gives its
+key up so that a retry runs again. Keys are deleted IDEMPOTENCY_KEY_TTL
+seconds after they were claimed.
+"""
+import json
+import hashlib
+from functools import wraps
+from flask import request
+from services.models import IdempotencyKey
+
+
+def request_fingerprint():
+    """ Returns a SHA-256 of the method, path, query string and body of the request """
+    body = request.get_json(silent=True)
+    if body is None:
+        body = request.get_data(as_text=True)
+    else:
+        body = json.dumps(body, sort_keys=True, separators=(",", ":"))
+    parts = [request.method, request.path, request.query_string.decode("latin-1"), body]
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def _unpack(result):
+    """ Returns the (data, code, headers) of what a resource method returned """
+    if not isinstance(result, tuple):
+        return result, 200, {}
+    if len(result) == 2:
+        return result[0], result[1], {}
+    return result[0], result[1], dict(result[2] or {})
+
+
+def idempotent(method):
+    """ Answers retries of a resource method that carry the same Idempotency-Key with the first response """
+    @wraps(method)
+    def wrapper(self, customer_id, *args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return method(self, customer_id, *args, **kwargs)
+        fingerprint = request_fingerprint()
+        stored, claimed = IdempotencyKey.reserve(key, customer_id, fingerprint)
+        if not claimed:
+            data, code, headers = stored.replay(fingerprint)
+            headers["Idempotent-Replayed"] = "true"
+            return data, code, headers
+        try:
+            data, code, headers = _unpack(method(self, customer_id, *args, **kwargs))
+        except Exception:
+            stored.release()
+            raise
+        if 200 <= code < 300:
+            stored.complete(code, data, headers)
+        else:
+            stored.release()
+        headers["Idempotent-Replayed"] = "false"
+        return data, code, headers
+    return wrapper
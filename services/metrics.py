@@ -0,0 +1,131 @@
+"""
+Prometheus metrics of the service
+
+Requests are counted and timed per flask-restx resource and HTTP method,
+and every SQL statement is timed per kind of statement. The metrics are
+served at /metrics in the Prometheus text format.
+
+Each response also tells how many SQL statements the request ran and how
+long they took, in the X-Query-Count and Server-Timing headers. Requests
+that run more than QUERY_COUNT_WARN_THRESHOLD statements are logged, as
+they usually query once per item where one statement would do.
+
+Under gunicorn every worker keeps its own metrics. Point the environment
+variable PROMETHEUS_MULTIPROC_DIR at an empty directory that all of the
+workers share, and /metrics adds up the metrics of all of them whichever
+worker answers. The directory must be emptied before the server starts.
+"""
+import os
+import time
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Import Flask application
+from . import app
+
+REQUESTS = Counter(
+    "shopcart_http_requests_total", "HTTP requests answered", ["resource", "method", "status"]
+)
+ERRORS = Counter(
+    "shopcart_http_errors_total", "HTTP requests answered with a server error", ["resource", "method"]
+)
+LATENCY = Histogram(
+    "shopcart_http_request_duration_seconds", "Time spent answering HTTP requests", ["resource", "method"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+DB_LATENCY = Histogram(
+    "shopcart_db_query_duration_seconds", "Time spent running SQL statements", ["statement"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+
+def resource_name():
+    """ Returns the flask-restx resource, or the Flask view, that handles the request """
+    view = app.view_functions.get(request.endpoint)
+    if view is None:
+        return "unmatched"
+    view_class = getattr(view, "view_class", None)
+    return view_class.__name__ if view_class else request.endpoint
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+@app.before_request
+def start_timer():
+    """ Remembers when the request started """
+    g.request_start = time.perf_counter()
+    g.query_count = 0
+    g.query_time = 0.0
+
+
+@app.after_request
+def record_request(response):
+    """ Counts and times the request """
+    start = g.pop("request_start", None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    add_query_headers(response, elapsed)
+    if request.endpoint == "metrics":
+        return response
+    resource = resource_name()
+    method = request.method.lower()
+    LATENCY.labels(resource, method).observe(elapsed)
+    REQUESTS.labels(resource, method, response.status_code).inc()
+    if response.status_code >= 500:
+        ERRORS.labels(resource, method).inc()
+    return response
+
+
+def add_query_headers(response, elapsed):
+    """ Reports the SQL statements of the request in its response """
+    count = g.pop("query_count", 0)
+    query_time = g.pop("query_time", 0.0)
+    response.headers["X-Query-Count"] = str(count)
+    response.headers["Server-Timing"] = 'db;dur={:.2f};desc="{} queries", total;dur={:.2f}'.format(
+        query_time * 1000, count, elapsed * 1000
+    )
+    if count > app.config["QUERY_COUNT_WARN_THRESHOLD"]:
+        app.logger.warning("%s %s ran %d SQL statements", request.method, request.path, count)
+
+
+######################################################################
+#  S Q L   H O O K S
+######################################################################
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    """ Remembers when the statement started """
+    # kept on the statement, which is dropped with it when it fails
+    if context is not None:
+        context.query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    """ Times the statement by its first keyword """
+    start = getattr(context, "query_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    DB_LATENCY.labels(statement.lstrip().split(None, 1)[0].upper()).observe(elapsed)
+    if has_request_context() and "query_count" in g:
+        g.query_count += 1
+        g.query_time += elapsed
+
+
+######################################################################
+#  GET METRICS
+######################################################################
+@app.route("/metrics")
+def metrics():
+    """ Returns the metrics of all the workers in the Prometheus text format """
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,149 @@
+"""
+Schema migrations for the shopcart database
+
+db.create_all() only creates the tables that are missing, it never changes
+a table that already exists. Every change to an existing table is therefore
+a numbered migration in MIGRATIONS. Each one is applied once, in order, and
+recorded in the schema_version table.
+
+Migrations describe the schema as it was at their version, so they reflect
+the tables they change instead of importing the current models.
+"""
+import logging
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, func, inspect, select, text
+
+logger = logging.getLogger("flask.app")
+
+# Kept apart from the models' metadata so db.drop_all() never forgets the applied versions
+metadata = MetaData()
+
+schema_version = Table(
+    "schema_version",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(128), nullable=False),
+    Column("applied_at", DateTime, server_default=func.now()),
+)
+
+# Any constant works, it only has to be the same in every worker
+ADVISORY_LOCK_KEY = 7263001
+
+
+######################################################################
+#  M I G R A T I O N S
+######################################################################
+def _create_missing_indexes(connection, table_name, indexes):
+    """ Creates the indexes of a table that do not exist yet """
+    existing = {index["name"] for index in inspect(connection).get_indexes(table_name)}
+    table = Table(table_name, MetaData(), autoload_with=connection)
+    for name, columns in indexes:
+        if name not in existing:
+            logger.info("Creating index %s on %s", name, table_name)
+            Index(name, *[table.c[column] for column in columns]).create(connection)
+
+
+def _add_missing_columns(connection, table_name, columns):
+    """ Adds the columns of a table that do not exist yet """
+    existing = {column["name"] for column in inspect(connection).get_columns(table_name)}
+    for name, definition in columns:
+        if name not in existing:
+            logger.info("Adding column %s to %s", name, table_name)
+            connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(table_name, name, definition)))
+
+
+def add_price_and_product_indexes(connection):
+    """ Indexes for the price queries and the product-centric lookups """
+    _create_missing_indexes(connection, "shopcart", [
+        ("ix_shopcart_product_price", ["product_price"]),
+        ("ix_shopcart_customer_id_product_price", ["customer_id", "product_price"]),
+        ("ix_shopcart_product_id", ["product_id"]),
+    ])
+
+
+def store_prices_as_numeric(connection):
+    """ Exact prices, so that totals computed in SQL add up to the cent """
+    # SQLite columns take any number whatever their declared type
+    if connection.dialect.name == "postgresql":
+        rounded = connection.execute(text(
+            "SELECT COUNT(*) FROM shopcart WHERE product_price::numeric <> ROUND(product_price::numeric, 2)"
+        )).scalar()
+        if rounded:
+            logger.warning("Rounding the prices of %d shopcart items with fractions of a cent", rounded)
+        connection.execute(text("ALTER TABLE shopcart ALTER COLUMN product_price TYPE NUMERIC(12, 2)"))
+
+
+def add_idempotency_fingerprints(connection):
+    """ Idempotency keys of any mutating request, matched by fingerprint and evicted by age """
+    if "idempotency_key" not in inspect(connection).get_table_names():
+        return  # db.create_all() makes it with every column
+    _add_missing_columns(connection, "idempotency_key", [
+        ("fingerprint", "VARCHAR(64)"),
+        ("status_code", "INTEGER"),
+        ("headers", "TEXT"),
+    ])
+    # results stored by checkout before this migration were all 200 OK
+    connection.execute(text("UPDATE idempotency_key SET status_code = 200 WHERE status_code IS NULL"))
+    _create_missing_indexes(connection, "idempotency_key", [
+        ("ix_idempotency_key_created_at", ["created_at"]),
+    ])
+
+
+def record_idempotency_claims(connection):
+    """ When a key was claimed, so that a retry can take over a claim its worker never completed """
+    if "idempotency_key" not in inspect(connection).get_table_names():
+        return
+    _add_missing_columns(connection, "idempotency_key", [("claimed_at", "TIMESTAMP")])
+    connection.execute(text("UPDATE idempotency_key SET claimed_at = created_at WHERE claimed_at IS NULL"))
+
+
+def number_cart_versions(connection):
+    """ Versions numbered across all shopcarts, so the collection ETag is the highest one instead of their sum """
+    if "cart_version" not in inspect(connection).get_table_names():
+        return
+    _create_missing_indexes(connection, "cart_version", [("ix_cart_version_version", ["version"])])
+    # the highest version starts from the old sum, so the collection ETags served so far never come back
+    connection.execute(text(
+        "UPDATE cart_version SET version = (SELECT SUM(version) FROM cart_version) "
+        "WHERE customer_id = (SELECT customer_id FROM cart_version ORDER BY version DESC LIMIT 1)"
+    ))
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("ALTER TABLE cart_version ALTER COLUMN version TYPE BIGINT"))
+        connection.execute(text("CREATE SEQUENCE IF NOT EXISTS cart_version_seq"))
+        connection.execute(text(
+            "SELECT setval('cart_version_seq', GREATEST((SELECT COALESCE(MAX(version), 0) FROM cart_version), "
+            "(SELECT last_value FROM cart_version_seq)))"
+        ))
+
+
+# (version, description, migration) in the order they must be applied
+MIGRATIONS = [
+    (1, "Add price and product indexes", add_price_and_product_indexes),
+    (2, "Store prices as NUMERIC(12, 2)", store_prices_as_numeric),
+    (3, "Add fingerprints to idempotency keys", add_idempotency_fingerprints),
+    (4, "Record when idempotency keys were claimed", record_idempotency_claims),
+    (5, "Number the versions of all shopcarts from one sequence", number_cart_versions),
+]
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def current_version(connection):
+    """ Returns the last migration applied to the database """
+    return connection.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def upgrade(engine):
+    """ Applies the migrations that the database has not seen yet """
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            # serialize workers that boot at the same time
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), key=ADVISORY_LOCK_KEY)
+        metadata.create_all(connection)
+        version = current_version(connection)
+        for number, description, migration in MIGRATIONS:
+            if number <= version:
+                continue
+            logger.info("Applying migration %d: %s", number, description)
+            migration(connection)
+            connection.execute(schema_version.insert().values(version=number, description=description))
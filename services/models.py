@@ -4,6 +4,8 @@ All of the models are stored in this module
 Models
 ------
 Shopcart
+CartVersion
+IdempotencyKey
 Attributes:
 -----------
 product_id - (TBD) from the product API
@@ -13,13 +15,95 @@ product_price - (TBD) from the product API
 quantity - (integer) quantity of the items
 """
 
+import os
+import json
 import logging
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import and_, bindparam, func, literal_column, tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from services import migrations
+from services.cache import CartCache
+from services.writebehind import QuantityBuffer
+from services.replicas import RoutingSQLAlchemy, replica_binds, replica_router
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+# Smallest amount of money the totals are rounded to
+CENT = Decimal("0.01")
+
+# Serialized shopcarts by customer_id, configured in init_db()
+cart_cache = CartCache()
+
+# Pending quantity changes written in batches, configured in init_db()
+quantity_buffer = QuantityBuffer()
+
+# Columns of the rows returned by the Shopcart.read_* methods, in order
+READ_COLUMNS = ("customer_id", "product_id", "product_name", "product_price", "quantity")
+
+
+def _supports_returning():
+    """ Tells if the database returns rows from UPDATE and DELETE statements """
+    return db.engine.dialect.name == "postgresql"
+
+
+def _supports_upsert():
+    """ Tells if the database has INSERT ... ON CONFLICT DO UPDATE """
+    return db.engine.dialect.name == "postgresql"
+
+
+def _commit(*customer_ids, deferrable=True):
+    """
+    Commits the session along with a new version of the shopcarts it
+    changed, then forgets their cached copies
+    A request that claimed an Idempotency-Key only flushes, and its changes
+    are committed along with its response by IdempotencyKey.complete()
+    """
+    customer_ids = sorted(set(customer_ids))  # same lock order in every transaction
+    for customer_id in customer_ids:
+        CartVersion.bump(customer_id)
+    deferred = db.session.info.get(IdempotencyKey.DEFERRED)
+    if deferrable and deferred is not None:
+        db.session.flush()
+        deferred.update(customer_ids)
+        return
+    db.session.commit()
+    for customer_id in customer_ids:
+        cart_cache.invalidate(customer_id)
+
+
+def _price(value):
+    """ Returns a price that has whole cents, which NUMERIC(12, 2) stores without rounding it """
+    try:
+        cents = Decimal(str(value))
+    except ArithmeticError:
+        raise DataValidationError("Invalid Shopcart: product_price is not a number: {!r}".format(value))
+    if isinstance(value, bool) or not cents.is_finite() or cents != cents.quantize(CENT):
+        raise DataValidationError(
+            "Invalid Shopcart: product_price must have at most two decimals: {!r}".format(value)
+        )
+    return value
+
+
+def dispose_engine():
+    """ Drops the pooled connections inherited from the parent of a forked worker """
+    app = getattr(Shopcart, "app", None)
+    if app is None:
+        return
+    for bind in [None] + list(app.config["SQLALCHEMY_BINDS"] or ()):
+        engine = db.get_engine(app, bind)
+        if engine.url.get_backend_name() == "sqlite" and engine.url.database in (None, "", ":memory:"):
+            continue  # the database lives in the one connection of the pool
+        engine.dispose()
+
+
+# A worker forked from a preloaded app opens its own connections
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=dispose_engine)
 
 
 class DataValidationError(Exception):
@@ -30,6 +114,14 @@ class DatabaseConnectionError(Exception):
     """Custom Exception when database connection fails"""
     pass
 
+class IdempotencyKeyReusedError(Exception):
+    """ Used when an Idempotency-Key comes back with a different request """
+    pass
+
+class RequestInProgressError(Exception):
+    """ Used when a request is retried while the first one is still running """
+    pass
+
 class Shopcart(db.Model):
     """
     Class that represents a shopcart
@@ -38,11 +130,17 @@ class Shopcart(db.Model):
 
     # Table Schema
     customer_id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True, index=True)
     product_name = db.Column(db.String(64), nullable=False)
-    product_price = db.Column(db.Float, nullable=False)
+    # exact in the database so that totals add up to the cent
+    product_price = db.Column(db.Numeric(12, 2, asdecimal=False), nullable=False, index=True)
     quantity = db.Column(db.Integer)
 
+    # Existing databases get new indexes from services/migrations.py
+    __table_args__ = (
+        db.Index("ix_shopcart_customer_id_product_price", "customer_id", "product_price"),
+    )
+
     def __repr__(self):
         return "<customer id=[%s]>,<product id=[%s]>" % (self.customer_id,self.product_id)
 
@@ -52,7 +150,80 @@ class Shopcart(db.Model):
         """
         logger.info("Creating customer_id: %s, product_id：%s", self.customer_id,self.product_id)
         db.session.add(self)
-        db.session.commit()
+        _commit(self.customer_id)
+
+    def upsert(self):
+        """
+        Creates a shopcart item, or adds its quantity to the item already in the shopcart
+        Returns:
+            (dict, bool): the serialized item as stored, and True if it was inserted
+        """
+        logger.info("Upserting customer_id: %s, product_id: %s", self.customer_id, self.product_id)
+        table = self.__table__
+        if _supports_upsert():
+            statement = postgresql.insert(table).values(self.serialize())
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.customer_id, table.c.product_id],
+                set_={"quantity": func.coalesce(table.c.quantity, 0) + statement.excluded.quantity}
+            ).returning(*table.c, literal_column("xmax = 0").label("inserted"))
+            item = dict(db.session.execute(statement).first())
+            _commit(self.customer_id)
+            return item, item.pop("inserted")
+        key = and_(table.c.customer_id == self.customer_id, table.c.product_id == self.product_id)
+        merge = table.update().where(key).values(
+            quantity=func.coalesce(table.c.quantity, 0) + (self.quantity or 0)
+        )
+        # try the merge first, and again if someone else inserts the item under us
+        for _ in range(2):
+            if db.session.execute(merge).rowcount:
+                item = dict(db.session.execute(table.select().where(key)).first())
+                _commit(self.customer_id)
+                return item, False
+            try:
+                db.session.execute(table.insert().values(self.serialize()))
+                _commit(self.customer_id)
+                return self.serialize(), True
+            except IntegrityError:
+                db.session.rollback()
+        raise DataValidationError("Product was changed concurrently, please retry")
+
+    @classmethod
+    def create_many(cls, shopcarts):
+        """
+        Creates a batch of shopcart items with one multi-row INSERT and one commit
+        Items whose (customer_id, product_id) already exist in the database or
+        earlier in the batch are not inserted and are returned as conflicts
+        Args:
+            shopcarts (list): the Shopcart items to create
+        Returns:
+            (created, conflicts): two lists of Shopcart
+        """
+        logger.info("Creating %d shopcart items", len(shopcarts))
+        # IN on both columns returns a superset of the keys, the exact pairs are checked below
+        existing = set(
+            db.session.query(cls.customer_id, cls.product_id).filter(
+                cls.customer_id.in_({shopcart.customer_id for shopcart in shopcarts}),
+                cls.product_id.in_({shopcart.product_id for shopcart in shopcarts}),
+            )
+        )
+        created, conflicts = [], []
+        for shopcart in shopcarts:
+            key = (shopcart.customer_id, shopcart.product_id)
+            if key in existing:
+                conflicts.append(shopcart)
+            else:
+                existing.add(key)
+                created.append(shopcart)
+        if created:
+            try:
+                db.session.execute(
+                    cls.__table__.insert().values([shopcart.serialize() for shopcart in created])
+                )
+                _commit(*{shopcart.customer_id for shopcart in created})
+            except IntegrityError:
+                db.session.rollback()
+                raise DataValidationError("Products were added to the shopcart concurrently, please retry")
+        return created, conflicts
 
     def update(self):
         """
@@ -61,13 +232,127 @@ class Shopcart(db.Model):
         logger.info("Saving %s", self.customer_id)
         if not self.customer_id:
             raise DataValidationError("Update called with empty ID field")
-        db.session.commit()
+        # the item may have been moved to another customer's shopcart
+        previous = db.inspect(self).attrs.customer_id.history.deleted
+        _commit(self.customer_id, *previous)
 
     def delete(self):
         """ Removes a shopcart from the data store """
         logger.info("Deleting %s,%s", self.customer_id,self.product_id)
         db.session.delete(self)
-        db.session.commit()
+        _commit(self.customer_id)
+
+    @classmethod
+    def adjust_quantity(cls, customer_id, product_id, delta):
+        """
+        Adds delta to the quantity of a shopcart item with a single UPDATE
+        The item is removed when its quantity drops to zero or below
+        Args:
+            customer_id (Integer)
+            product_id (Integer)
+            delta (Integer): the amount to add, negative to remove products
+        Returns:
+            dict: the serialized item with its new quantity, or None if it does not exist
+        """
+        logger.info("Adding %s to the quantity of customer_id: %s, product_id: %s", delta, customer_id, product_id)
+        table = cls.__table__
+        key = and_(table.c.customer_id == customer_id, table.c.product_id == product_id)
+        statement = table.update().where(key).values(quantity=func.coalesce(table.c.quantity, 0) + delta)
+        if _supports_returning():
+            row = db.session.execute(statement.returning(*table.c)).first()
+        elif db.session.execute(statement).rowcount:
+            # the UPDATE holds the row lock, so this read sees our own write
+            row = db.session.execute(table.select().where(key)).first()
+        else:
+            row = None
+        if row is None:
+            db.session.rollback()
+            return None
+        item = dict(row)
+        if item["quantity"] <= 0:
+            db.session.execute(table.delete().where(key))
+            item["quantity"] = 0
+        _commit(customer_id)
+        return item
+
+    @classmethod
+    def apply_quantity_changes(cls, changes):
+        """
+        Writes buffered quantity changes with one batched UPDATE per kind of change and one commit
+        Items whose quantity drops to zero or below through a delta are removed
+        Args:
+            changes (list): (customer_id, product_id, quantity, delta) tuples, where
+                a quantity of None means adding delta to the stored quantity
+        """
+        logger.info("Writing %d buffered quantity changes", len(changes))
+        table = cls.__table__
+        key = and_(table.c.customer_id == bindparam("key_customer_id"), table.c.product_id == bindparam("key_product_id"))
+        sets = [
+            {"key_customer_id": customer_id, "key_product_id": product_id, "new_quantity": quantity}
+            for customer_id, product_id, quantity, _ in changes if quantity is not None
+        ]
+        deltas = [
+            {"key_customer_id": customer_id, "key_product_id": product_id, "delta": delta}
+            for customer_id, product_id, quantity, delta in changes if quantity is None
+        ]
+        try:
+            if sets:
+                db.session.execute(table.update().where(key).values(quantity=bindparam("new_quantity")), sets)
+            if deltas:
+                db.session.execute(
+                    table.update().where(key).values(quantity=func.coalesce(table.c.quantity, 0) + bindparam("delta")),
+                    deltas
+                )
+                db.session.execute(table.delete().where(and_(key, table.c.quantity <= 0)), deltas)
+            # the changes were acknowledged when they were buffered, no request's response waits for them
+            _commit(*{change[0] for change in changes}, deferrable=False)
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @classmethod
+    def delete_by_customer_id(cls, customer_id):
+        """
+        Removes every item of a customer's shopcart with one DELETE and one commit
+        Args:
+            customer_id (Integer): the customer_id of the shopcart to remove
+        Returns:
+            list: the serialized items that were removed
+        """
+        logger.info("Deleting shopcart of customer %s", customer_id)
+        items = cls._remove_cart(customer_id)
+        # an empty shopcart did not change, so it keeps its version
+        _commit(*([customer_id] if items else []))
+        return items
+
+    @classmethod
+    def checkout(cls, customer_id):
+        """
+        Removes every item of a customer's shopcart in one transaction
+        Args:
+            customer_id (Integer): the customer_id of the shopcart to check out
+        Returns:
+            list: the serialized items that were removed
+        """
+        logger.info("Checking out shopcart of customer %s", customer_id)
+        items = cls._remove_cart(customer_id)
+        _commit(*([customer_id] if items else []))
+        return items
+
+    @classmethod
+    def _remove_cart(cls, customer_id):
+        """ Deletes the items of a shopcart in the current transaction and returns them """
+        table = cls.__table__
+        statement = table.delete().where(table.c.customer_id == customer_id)
+        if _supports_returning():
+            # the DELETE removes exactly the rows it returns, items added meanwhile stay
+            return [dict(row) for row in db.session.execute(statement.returning(*table.c))]
+        # no DELETE ... RETURNING, read the items in the same transaction first and
+        # only delete those, so an item added in between is neither lost nor returned
+        rows = db.session.execute(table.select().where(table.c.customer_id == customer_id)).fetchall()
+        if rows:
+            db.session.execute(statement.where(table.c.product_id.in_([row.product_id for row in rows])))
+        return [dict(row) for row in rows]
 
     def serialize(self):
         """ Serializes a shopcart into a dictionary """
@@ -89,7 +374,7 @@ class Shopcart(db.Model):
             self.customer_id = data["customer_id"]
             self.product_id = data["product_id"]
             self.product_name = data["product_name"]
-            self.product_price = data["product_price"]
+            self.product_price = _price(data["product_price"])
             self.quantity = data["quantity"]
             # if isinstance(data["customer_id"], int):
             #     self.customer_id = data["customer_id"]
@@ -130,10 +415,30 @@ class Shopcart(db.Model):
         """ Initializes the database session """
         logger.info("Initializing database")
         cls.app = app
+        cart_cache.configure(
+            app.config["CART_CACHE_ENABLED"], app.config["CART_CACHE_SIZE"], app.config["CART_CACHE_TTL"]
+        )
+        IdempotencyKey.ttl = app.config["IDEMPOTENCY_KEY_TTL"]
+        IdempotencyKey.lease = app.config["IDEMPOTENCY_KEY_LEASE"]
+        app.config["SQLALCHEMY_BINDS"] = replica_binds(app.config["DATABASE_REPLICA_URIS"])
+        replica_router.configure(app.config["SQLALCHEMY_BINDS"], app.config["REPLICA_STICKY_SECONDS"])
+        quantity_buffer.configure(
+            app.config["WRITE_BEHIND_ENABLED"], app.config["WRITE_BEHIND_INTERVAL"],
+            app.config["WRITE_BEHIND_MAX_PENDING"], apply=cls.apply_quantity_changes, context=app.app_context,
+            on_written=replica_router.wrote
+        )
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
+        if app.config["DB_CREATE_SCHEMA"]:
+            cls.create_schema()
+
+    @classmethod
+    def create_schema(cls):
+        """ Creates the missing tables and brings the existing ones up to date """
+        logger.info("Creating the database schema")
         db.create_all()  # make our sqlalchemy tables
+        migrations.upgrade(db.engine)  # bring existing tables up to date
 
     @classmethod
     def all(cls):
@@ -141,6 +446,17 @@ class Shopcart(db.Model):
         logger.info("Processing all shopcarts")
         return cls.query.all()
 
+    @classmethod
+    def stream_all(cls, batch_size):
+        """Returns an iterator over all of the shopcarts in the database
+        Rows are fetched through a server-side cursor batch_size rows at a
+        time, so memory stays flat no matter how big the table is
+        Args:
+            batch_size (Integer): the number of rows fetched per round trip
+        """
+        logger.info("Streaming all shopcarts in batches of %s", batch_size)
+        return cls.query.yield_per(batch_size)
+
     @classmethod
     def find_by_customer_id(cls, customer_id):
         """Returns the shopcart with the given customer_id
@@ -150,6 +466,76 @@ class Shopcart(db.Model):
         logger.info("Processing query for customer %s ...", customer_id)
         return cls.query.filter(cls.customer_id == customer_id)
 
+    @classmethod
+    def find_cart(cls, customer_id):
+        """Returns the serialized items of a customer's shopcart, through the cart cache
+        Args:
+            customer_id (Integer): the customer_id that the shopcart matches
+        """
+        if not cart_cache.enabled:
+            return [dict(row) for row in cls.read_cart(customer_id)]
+        cached = cart_cache.get(customer_id)
+        if cached is None:
+            token = cart_cache.token()
+            # the version is read first, so it is never newer than the items
+            version = CartVersion.find(customer_id)
+            cart = [dict(row) for row in cls.read_cart(customer_id)]
+            cart_cache.put(customer_id, (version, cart), token)
+            return cart
+        return cached[1]
+
+    @classmethod
+    def find_cart_version(cls, customer_id):
+        """Returns the version of a customer's shopcart, through the cart cache
+        Args:
+            customer_id (Integer): the customer_id that the shopcart matches
+        """
+        cached = cart_cache.get(customer_id)
+        if cached is None:
+            return CartVersion.find(customer_id)
+        return cached[0]
+
+    @classmethod
+    def find_cart_item(cls, customer_id, product_id):
+        """Returns the serialized shopcart item with the given customer_id and product_id
+        The item comes from the cached shopcart when the cart cache is enabled
+        Args:
+            customer_id (Integer)
+            product_id (Integer)
+        """
+        if not cart_cache.enabled:
+            shopcart = cls.find_by_shopcart_item(customer_id, product_id)
+            return shopcart.serialize() if shopcart else None
+        for item in cls.find_cart(customer_id):
+            if str(item["product_id"]) == str(product_id):
+                return item
+        return None
+
+    @classmethod
+    def summarize(cls, customer_ids):
+        """Returns the totals of shopcarts from a single SQL aggregate
+        Args:
+            customer_ids (list): the customer_ids of the shopcarts to summarize
+        Returns:
+            list: a dict of item_count, total_quantity and total_value per non-empty shopcart
+        """
+        logger.info("Processing summary for customers %s ...", customer_ids)
+        rows = db.session.query(
+            cls.customer_id,
+            func.count().label("item_count"),
+            func.coalesce(func.sum(cls.quantity), 0).label("total_quantity"),
+            func.coalesce(func.sum(cls.product_price * cls.quantity), 0).label("total_value"),
+        ).filter(cls.customer_id.in_(customer_ids)).group_by(cls.customer_id).order_by(cls.customer_id)
+        return [
+            {
+                "customer_id": row.customer_id,
+                "item_count": row.item_count,
+                "total_quantity": row.total_quantity,
+                "total_value": Decimal(str(row.total_value)).quantize(CENT),
+            }
+            for row in rows
+        ]
+
     @classmethod
     def find_shopcart_items_price_by_customer_id(cls, customer_id, price_threshold):
         """Returns the shopcart with the given customer_id
@@ -169,6 +555,79 @@ class Shopcart(db.Model):
         logger.info("Processing query for price thresold %s ...", price_threshold)
         return cls.query.filter(cls.product_price >= price_threshold)
 
+    @classmethod
+    def find_page(cls, limit, after=None, price_threshold=None):
+        """Returns one page of shopcart items in (customer_id, product_id) order
+        Args:
+            limit (Integer): the maximum number of items to return
+            after (tuple): the (customer_id, product_id) key of the last item already returned
+            price_threshold (Float): the price above which we return results
+        """
+        logger.info("Processing page query of %s items after %s ...", limit, after)
+        query = cls.query.filter(*cls._page_criteria(after, price_threshold))
+        return query.order_by(cls.customer_id, cls.product_id).limit(limit).all()
+
+    @classmethod
+    def _page_criteria(cls, after, price_threshold):
+        """ Returns the WHERE clauses of a page of shopcart items """
+        criteria = []
+        if price_threshold is not None:
+            criteria.append(cls.product_price >= price_threshold)
+        if after is not None:
+            # keyset condition on the primary key so that every page is an index range scan
+            criteria.append(tuple_(cls.customer_id, cls.product_id) > tuple_(*after))
+        return criteria
+
+    # The read_* methods select the five columns with a Core statement and
+    # return plain rows instead of Shopcart instances, which skips the
+    # identity map and change tracking that read-only responses never use.
+    # Rows hold the columns in the order of READ_COLUMNS and can also be
+    # read by column name.
+
+    @classmethod
+    def _read(cls, *criteria, order_by=(), limit=None):
+        """ Returns the rows of the shopcart items that match criteria """
+        columns = [getattr(cls, name) for name in READ_COLUMNS]
+        statement = db.select(columns).where(and_(*criteria)).order_by(*order_by).limit(limit)
+        return db.session.execute(statement).fetchall()
+
+    @classmethod
+    def read_all(cls, price_threshold=None):
+        """Returns the rows of all the shopcart items, or of those above a price threshold
+        Args:
+            price_threshold (Float): the price above which we return results
+        """
+        logger.info("Processing rows query for price threshold %s ...", price_threshold)
+        if price_threshold:
+            return cls._read(cls.product_price >= price_threshold)
+        return cls._read()
+
+    @classmethod
+    def read_cart(cls, customer_id, price_threshold=None):
+        """Returns the rows of a customer's shopcart, or of its items above a price threshold
+        Args:
+            customer_id (Integer): the customer_id that the shopcart matches
+            price_threshold (Float): the price above which we return results
+        """
+        logger.info("Processing rows query for customer %s ...", customer_id)
+        criteria = [cls.customer_id == customer_id]
+        if price_threshold:
+            criteria.append(cls.product_price >= price_threshold)
+        return cls._read(*criteria)
+
+    @classmethod
+    def read_page(cls, limit, after=None, price_threshold=None):
+        """Returns the rows of one page of shopcart items, see find_page()
+        Args:
+            limit (Integer): the maximum number of items to return
+            after (tuple): the (customer_id, product_id) key of the last item already returned
+            price_threshold (Float): the price above which we return results
+        """
+        logger.info("Processing page rows query of %s items after %s ...", limit, after)
+        return cls._read(
+            *cls._page_criteria(after, price_threshold), order_by=(cls.customer_id, cls.product_id), limit=limit
+        )
+
     # @classmethod
     # def find_or_404(cls, customer_id,product_id):
     #     """ Find a shopcart by it's compound key """
@@ -183,4 +642,242 @@ class Shopcart(db.Model):
             product_id (Integer)
         """
         logger.info("Processing query for customer_id: %s ... and product_id: %s", customer_id, product_id)
-        return cls.query.get((customer_id, product_id))
\ No newline at end of file
+        return cls.query.get((customer_id, product_id))
+
+
+class CartVersion(db.Model):
+    """
+    Class that counts the changes made to each shopcart
+    The version goes up in the same transaction as every change to the
+    items of the shopcart and is never reset, so it can tag what a client
+    has already read. Versions are numbered across all shopcarts, so the
+    highest one changes whenever any shopcart does
+    """
+
+    # Table Schema
+    customer_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.BigInteger, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<customer id=[%s]>,<version=[%s]>" % (self.customer_id, self.version)
+
+    @classmethod
+    def bump(cls, customer_id):
+        """Adds one to the version of a shopcart in the current transaction
+        Args:
+            customer_id (Integer): the customer_id of the shopcart that changed
+        """
+        table = cls.__table__
+        if _supports_upsert():
+            # a sequence hands out numbers without locking anything shared by every shopcart
+            statement = postgresql.insert(table).values(customer_id=customer_id, version=cart_version_seq.next_value())
+            db.session.execute(statement.on_conflict_do_update(
+                index_elements=[table.c.customer_id],
+                # a transaction that drew its number earlier may lock the row later
+                set_={"version": func.greatest(statement.excluded.version, table.c.version + 1)}
+            ))
+            return
+        # other databases write one transaction at a time, so the highest version is the last one
+        versions = table.alias()
+        next_version = db.select([func.coalesce(func.max(versions.c.version), 0) + 1]).as_scalar()
+        statement = table.update().where(table.c.customer_id == customer_id).values(version=next_version)
+        if not db.session.execute(statement).rowcount:
+            db.session.execute(table.insert().values(customer_id=customer_id, version=next_version))
+
+    @classmethod
+    def find(cls, customer_id):
+        """Returns the version of a shopcart, 0 if it never changed
+        Args:
+            customer_id (Integer): the customer_id that the shopcart matches
+        """
+        return db.session.query(cls.version).filter(cls.customer_id == customer_id).scalar() or 0
+
+    @classmethod
+    def total(cls):
+        """Returns a number that goes up with every change to any shopcart
+        It is the highest version, read from the end of its index
+        """
+        return db.session.query(func.max(cls.version)).scalar() or 0
+
+
+# Numbers the versions of the shopcarts on databases that have sequences
+cart_version_seq = db.Sequence("cart_version_seq", metadata=db.Model.metadata)
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that stores the result of a request made with an Idempotency-Key
+    A retry of the request with the same key gets the stored result back
+    instead of doing the work again. Keys are forgotten after ttl seconds.
+    """
+
+    # Seconds a key is kept, set by Shopcart.init_db()
+    ttl = 86400
+    # Seconds after which the claim of a request that never completed is
+    # taken over by a retry, set by Shopcart.init_db()
+    lease = 30
+    # Key of the session info holding the shopcarts a claimed request changed
+    DEFERRED = "idempotency_claim"
+    # Expired keys are deleted at most this often by each worker
+    eviction_interval = 60
+    _last_eviction = None
+
+    # Table Schema
+    key = db.Column(db.String(255), primary_key=True)
+    customer_id = db.Column(db.Integer, nullable=False)
+    # SHA-256 of the method, path, query string and body of the request
+    fingerprint = db.Column(db.String(64))
+    # None while the first request is still running
+    status_code = db.Column(db.Integer)
+    response = db.Column(db.Text, nullable=False)
+    headers = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=func.now(), index=True)
+    # when the running request claimed the key, or a retry took it over
+    claimed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<idempotency key=[%s]>,<customer id=[%s]>" % (self.key, self.customer_id)
+
+    @staticmethod
+    def _check(key):
+        if len(key) > 255:
+            raise DataValidationError("Invalid Idempotency-Key: longer than 255 characters")
+
+    @classmethod
+    def reserve(cls, key, customer_id, fingerprint):
+        """Claims a key for a request that is about to run, in its own transaction
+        Until the claim is completed or released, the changes of the request
+        are flushed but not committed
+        Args:
+            key (String): the Idempotency-Key of the request
+            customer_id (Integer): the customer_id of the shopcart the request changes
+            fingerprint (String): what identifies the request
+        Returns:
+            (IdempotencyKey, bool): the key, and True if this request claimed it and
+            must complete() or release() it, False if an earlier request did
+        """
+        cls._check(key)
+        cls.evict_expired()
+        now = datetime.utcnow()
+        stored = cls.query.get(key)
+        if stored is not None and stored.expired():
+            db.session.delete(stored)
+            db.session.flush()
+            stored = None
+        if stored is not None:
+            if stored.fingerprint != fingerprint or not stored.abandoned(now):
+                return stored, False
+            # the worker died before it completed, and the changes it deferred died with it
+            taken = db.session.query(cls).filter(
+                cls.key == key, cls.status_code.is_(None), cls.claimed_at == stored.claimed_at
+            ).update({"claimed_at": now}, synchronize_session=False)
+            db.session.commit()
+            if taken:
+                logger.warning("Taking over the Idempotency-Key %s of a request that never completed", key)
+                return stored._claim(now), True
+            stored = cls.query.get(key)
+            if stored is not None:
+                return stored, False
+        claim = cls(key=key, customer_id=customer_id, fingerprint=fingerprint, response="", claimed_at=now)
+        db.session.add(claim)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # the same key was claimed concurrently
+            db.session.rollback()
+            stored = cls.query.get(key)
+            if stored is None:
+                raise
+            return stored, False
+        return claim._claim(now), True
+
+    def _claim(self, claimed_at):
+        """ Defers the commits of the session until the claim is completed or released """
+        self._claimed_at = claimed_at
+        db.session.info[self.DEFERRED] = set()
+        return self
+
+    def complete(self, status_code, response, headers=None):
+        """Stores the response of the request that claimed the key, and commits
+        it along with the changes of the request
+        Raises:
+            RequestInProgressError: if a retry took the claim over, the changes are then rolled back
+        """
+        customer_ids = db.session.info.pop(self.DEFERRED, set())
+        try:
+            stored = db.session.query(IdempotencyKey).filter(
+                IdempotencyKey.key == self.key, IdempotencyKey.status_code.is_(None),
+                IdempotencyKey.claimed_at == self._claimed_at
+            ).update({
+                "status_code": status_code,
+                "response": json.dumps(response, separators=(",", ":")),
+                "headers": json.dumps(headers) if headers else None,
+            }, synchronize_session=False)
+            if not stored:
+                raise RequestInProgressError("A retry with this Idempotency-Key took over the request")
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for customer_id in customer_ids:
+            cart_cache.invalidate(customer_id)
+
+    def release(self):
+        """ Gives the key up so that a retry runs the request again """
+        db.session.info.pop(self.DEFERRED, None)
+        db.session.rollback()
+        db.session.query(IdempotencyKey).filter(
+            IdempotencyKey.key == self.key, IdempotencyKey.status_code.is_(None),
+            IdempotencyKey.claimed_at == self._claimed_at
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    def abandoned(self, now=None):
+        """ Tells if the key is claimed by a request that has not completed for longer than the lease """
+        now = now or datetime.utcnow()
+        return self.status_code is None and (self.claimed_at or self.created_at) < now - timedelta(seconds=self.lease)
+
+    def expired(self):
+        """ Tells if the key is older than its time-to-live """
+        return self.created_at < datetime.utcnow() - timedelta(seconds=self.ttl)
+
+    @classmethod
+    def find(cls, key):
+        """Returns the stored result of the request made with a key, or None
+        Args:
+            key (String): the Idempotency-Key of the request
+        """
+        stored = cls.query.get(key)
+        if stored is None or stored.expired():
+            return None
+        return stored
+
+    @classmethod
+    def evict_expired(cls, now=None):
+        """Deletes the keys older than their time-to-live, at most every eviction_interval seconds
+        Returns:
+            int: the number of keys deleted
+        """
+        now = now or datetime.utcnow()
+        if cls._last_eviction and now - cls._last_eviction < timedelta(seconds=cls.eviction_interval):
+            return 0
+        cls._last_eviction = now
+        count = db.session.query(cls).filter(cls.created_at < now - timedelta(seconds=cls.ttl)).delete()
+        db.session.commit()
+        if count:
+            logger.info("Evicted %d expired idempotency keys", count)
+        return count
+
+    def replay(self, fingerprint):
+        """Returns the stored response of the request
+        Args:
+            fingerprint (String): what identifies the retried request
+        Returns:
+            (body, status_code, headers)
+        """
+        if self.fingerprint != fingerprint:
+            raise IdempotencyKeyReusedError("Idempotency-Key was already used for another request")
+        if self.status_code is None:
+            raise RequestInProgressError("A request with this Idempotency-Key is still running")
+        logger.info("Replaying the request made with Idempotency-Key %s", self.key)
+        return json.loads(self.response), self.status_code, json.loads(self.headers) if self.headers else {}
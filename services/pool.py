@@ -0,0 +1,80 @@
+"""
+Database connection pool settings and statistics
+
+Each worker process has its own pool, so the database sees up to
+workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections. The statistics
+tell how close a worker runs to its limit and how long requests wait to
+check out a connection.
+"""
+import time
+import threading
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ A QueuePool that measures how long checkouts wait for a connection """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+
+    def stats(self):
+        """ Returns the live state of the pool and its checkout wait times """
+        return {
+            "size": self.size(),
+            "max_overflow": self._max_overflow,
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": max(self.overflow(), 0),
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_time_total": self.wait_time,
+            "wait_time_max": self.max_wait_time,
+        }
+
+
+def engine_options(config, uri=None):
+    """
+    Returns the SQLAlchemy engine options for the pool settings of config
+    Args:
+        uri (str): the database of the engine, by default SQLALCHEMY_DATABASE_URI
+    """
+    options = {"pool_pre_ping": config["DB_POOL_PRE_PING"]}
+    # SQLite gets a static or null pool from Flask-SQLAlchemy, sizes do not apply
+    if not (uri or config["SQLALCHEMY_DATABASE_URI"]).startswith("sqlite"):
+        options.update({
+            "poolclass": InstrumentedQueuePool,
+            "pool_size": config["DB_POOL_SIZE"],
+            "max_overflow": config["DB_MAX_OVERFLOW"],
+            "pool_recycle": config["DB_POOL_RECYCLE"],
+            "pool_timeout": config["DB_POOL_TIMEOUT"],
+        })
+    return options
+
+
+def pool_stats(pool):
+    """ Returns the statistics of any pool """
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats()
+    return {"status": pool.status()}
@@ -0,0 +1,140 @@
+"""
+Routing of reads to the read replicas of the database
+
+With DATABASE_REPLICA_URIS set, the SELECT statements of GET requests run
+on a replica picked at random, and every other statement, and every
+request that changes something, runs on the primary. A replica lags a
+little behind the primary, so for REPLICA_STICKY_SECONDS after a customer
+changed their shopcart, their reads stay on the primary and they see their
+own changes. The worker that answered the write remembers the customer,
+and the response sets a cookie that tells every other worker the same.
+"""
+import time
+import random
+import threading
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql import Select
+from services.pool import engine_options
+
+# Import Flask application
+from . import app
+
+# Cookie holding the time until which a client reads from the primary
+STICKY_COOKIE = "read-primary-until"
+
+# Requests that only read
+SAFE_METHODS = ("GET", "HEAD")
+
+
+class ReplicaRouter:
+    """ The replica binds of a worker and the customers who wrote recently """
+
+    def __init__(self, replicas=(), window=5.0, clock=time.monotonic):
+        self._lock = threading.Lock()
+        self._writes = {}
+        self._clock = clock
+        self.primary_reads = 0
+        self.replica_reads = 0
+        self.configure(replicas, window)
+
+    def configure(self, replicas, window):
+        """ Changes the bind keys of the replicas and forgets who wrote """
+        self.replicas = list(replicas)
+        self.window = window
+        with self._lock:
+            self._writes.clear()
+
+    def wrote(self, customer_id):
+        """ Keeps the reads of a customer on the primary for the next window seconds """
+        now = self._clock()
+        with self._lock:
+            if len(self._writes) > 10000:
+                self._writes = {key: until for key, until in self._writes.items() if until > now}
+            self._writes[str(customer_id)] = now + self.window
+
+    def is_sticky(self, customer_id):
+        """ Tells if a customer wrote less than window seconds ago """
+        return self._writes.get(str(customer_id), 0) > self._clock()
+
+    def choose(self, customer_id=None, sticky_until=0):
+        """ Returns the bind key of a replica to read from, or None to read from the primary """
+        if not self.replicas or sticky_until > time.time() or (customer_id is not None and self.is_sticky(customer_id)):
+            self.primary_reads += 1
+            return None
+        self.replica_reads += 1
+        return random.choice(self.replicas)
+
+    def stats(self):
+        """ Returns the counters and settings of the router """
+        return {
+            "replicas": len(self.replicas),
+            "window": self.window,
+            "sticky_customers": sum(1 for until in self._writes.values() if until > self._clock()),
+            "primary_reads": self.primary_reads,
+            "replica_reads": self.replica_reads,
+        }
+
+
+replica_router = ReplicaRouter()
+
+
+def replica_binds(uris):
+    """ Returns the SQLALCHEMY_BINDS of the replica URIs """
+    return {"replica{}".format(number): uri for number, uri in enumerate(uris)}
+
+
+class RoutingSession(SignallingSession):
+    """ A session that runs the plain SELECTs of a read-only request on its replica """
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = g.get("read_bind") if has_request_context() else None
+        if (bind is not None and not self._flushing and isinstance(clause, Select)
+                and clause._for_update_arg is None):  # pylint: disable=protected-access
+            return get_state(self.app).db.get_engine(self.app, bind=bind)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with sessions that read from the replicas and a pool sized per database """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # every bind gets the pool of its own database, the primary and the replicas may differ
+        options.update(engine_options(app.config, str(sa_url)))
+        return super().apply_driver_hacks(app, sa_url, options)
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+@app.before_request
+def choose_bind():
+    """ Picks where the SELECTs of the request run """
+    # g outlives the request when init_db pushed the app context for good
+    g.read_bind = None
+    if request.method not in SAFE_METHODS:
+        return
+    try:
+        sticky_until = float(request.cookies.get(STICKY_COOKIE, 0))
+    except ValueError:
+        sticky_until = 0
+    customer_id = (request.view_args or {}).get("customer_id")
+    g.read_bind = replica_router.choose(customer_id, sticky_until)
+
+
+@app.after_request
+def stick_to_primary(response):
+    """ Sends the reads of a client that changed something to the primary for a while """
+    if not replica_router.replicas or request.method in SAFE_METHODS or response.status_code >= 400:
+        return response
+    customer_id = (request.view_args or {}).get("customer_id")
+    if customer_id is not None:
+        replica_router.wrote(customer_id)
+    window = replica_router.window
+    response.set_cookie(STICKY_COOKIE, "{:.3f}".format(time.time() + window), max_age=int(window) + 1,
+                        httponly=True, samesite="Lax")
+    return response
@@ -4,19 +4,24 @@ My Service
 Describe what your service does here
 """
 
-import os
-import sys
+import hashlib
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
-from werkzeug.utils import validate_arguments
-from flask_restx import Api, Resource, fields, reqparse, inputs
+import click
+from flask import Response, g, request, url_for, abort, stream_with_context
+from flask_restx import Api, Resource, fields, reqparse, inputs, marshal
 from . import status  # HTTP Status Codes
-from werkzeug.exceptions import NotFound
+from werkzeug.http import quote_etag
 
-# For this example we'll use SQLAlchemy, a popular ORM that supports a
-# variety of backends including SQLite, MySQL, and PostgreSQL
-from flask_sqlalchemy import SQLAlchemy
-from services.models import Shopcart, DataValidationError, DatabaseConnectionError
+from services.models import (
+    Shopcart, CartVersion, DataValidationError, DatabaseConnectionError, IdempotencyKeyReusedError,
+    RequestInProgressError, cart_cache, quantity_buffer, db
+)
+from services.idempotency import idempotent
+from services.compression import etag_variants, send_static_file
+from services.pool import pool_stats
+from services.replicas import replica_router
+from services import serializers
+from services.serializers import RowEncoder, json_response
 
 # Import Flask application
 from . import app
@@ -28,7 +33,7 @@ from . import app
 @app.route("/")
 def index():
     """ Root URL response """
-    return app.send_static_file("index.html")  # use GUI
+    return send_static_file("index.html")  # use GUI
 
 ######################################################################
 # Configure Swagger before initializing it
@@ -56,9 +61,51 @@ shopcart_model = api.model('Shopcart', {
     'quantity': fields.Integer(required=True, description='The number of products added in the shopcart')
 })
 
+# List endpoints encode rows straight to JSON instead of marshalling them
+shopcart_encoder = RowEncoder(shopcart_model)
+
+# Result of adding a batch of products in one request
+shopcart_batch_model = api.model('ShopcartBatchResult', {
+    'created': fields.List(fields.Nested(shopcart_model),
+                           description='The products that were added to the shopcart'),
+    'conflicts': fields.List(fields.Nested(shopcart_model),
+                             description='The products that already existed and were not added')
+})
+
+# Change applied to the quantity of a product
+quantity_delta_model = api.model('QuantityDelta', {
+    'delta': fields.Integer(required=True,
+                            description='The number of products to add, negative to remove them')
+})
+
+# Totals of a shopcart computed by the database
+summary_model = api.model('ShopcartSummary', {
+    'customer_id': fields.Integer(description='The unique id for a customer or a shopcart'),
+    'item_count': fields.Integer(description='The number of different products in the shopcart'),
+    'total_quantity': fields.Integer(description='The number of products in the shopcart'),
+    'total_value': fields.Float(description='The sum of price times quantity, exact to the cent')
+})
+
+# header that makes retries of a mutating request safe
+idempotency_key_param = {
+    'Idempotency-Key': {'in': 'header', 'type': 'string',
+                        'description': 'Unique key of the request, a retry with the same key returns the first response'}
+}
+
 # query string arguments
+summary_args = reqparse.RequestParser()
+summary_args.add_argument('customer_id', type=int, action='append', required=True, location='args',
+                          help='The customers whose shopcarts are summarized, repeat for several')
+
 shopcart_args = reqparse.RequestParser()
 shopcart_args.add_argument('price', type=float, required=False, help='List Products higher than the provided price')
+shopcart_args.add_argument('limit', type=inputs.positive, required=False, help='Maximum number of Products in one page')
+shopcart_args.add_argument('after', type=str, required=False, help='Cursor returned in X-Next-Cursor by the previous page')
+
+# query string arguments for adding products
+product_args = reqparse.RequestParser()
+product_args.add_argument('merge', type=inputs.boolean, location='args', default=False,
+                          help='Add the quantity to the Product if it is already in the shopcart')
 
 ######################################################################
 # Special Error Handlers
@@ -74,6 +121,28 @@ def request_validation_error(error):
         'message': message
     }, status.HTTP_400_BAD_REQUEST
 
+@api.errorhandler(IdempotencyKeyReusedError)
+def idempotency_key_reused(error):
+    """ Handles an Idempotency-Key sent again with a different request """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_422_UNPROCESSABLE_ENTITY,
+        'error': 'Unprocessable Entity',
+        'message': message
+    }, status.HTTP_422_UNPROCESSABLE_ENTITY
+
+@api.errorhandler(RequestInProgressError)
+def request_in_progress(error):
+    """ Handles a retry that arrives while the first request is still running """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_409_CONFLICT,
+        'error': 'Conflict',
+        'message': message
+    }, status.HTTP_409_CONFLICT
+
 @api.errorhandler(DatabaseConnectionError)
 def database_connection_error(error):
     """ Handles Database Errors from connection attempts """
@@ -103,41 +172,40 @@ class ShopcartResource(Resource):
     ######################################################################
     @api.doc('get_shopcarts')
     @api.response(404, 'Shopcart for the customer does not exist!')
-    @api.marshal_list_with(shopcart_model)
+    @api.response(304, 'Shopcart not modified since the ETag in If-None-Match')
+    @api.response(200, 'Success', [shopcart_model])
     def get(self, customer_id):
         """
         Reads a shopcart
         """
         app.logger.info("Request to read a shopcart for customer " + customer_id)
+        etag = make_etag("cart", customer_id, Shopcart.find_cart_version(customer_id),
+                         quantity_buffer.sequence(customer_id), request.query_string)
+        if is_not_modified(etag):
+            return not_modified(etag)
         price_threshold = request.args.get('price')
         if price_threshold:
-            shopcarts = Shopcart.find_shopcart_items_price_by_customer_id(customer_id, price_threshold)
+            message = shopcart_encoder.dicts(Shopcart.read_cart(customer_id, price_threshold))
         else:
-            shopcarts = Shopcart.find_by_customer_id(customer_id).all()
-        if not shopcarts:
-            abort(status.HTTP_404_NOT_FOUND, "Shopcart for the customer does not exist!")
-
-        message = [shopcart.serialize() for shopcart in shopcarts]
-        return message, status.HTTP_200_OK
+            message = Shopcart.find_cart(customer_id)
+            if not message:
+                abort(status.HTTP_404_NOT_FOUND, "Shopcart for the customer does not exist!")
+        return json_response(quantity_buffer.overlay(message), status.HTTP_200_OK, etag_headers(etag))
 
         
     ######################################################################
     # DELETE A SHOPCART
     ######################################################################
-    @api.doc('delete_shopcart')
+    @api.doc('delete_shopcart', params=idempotency_key_param)
     @api.marshal_list_with(shopcart_model, code=204)
+    @idempotent
     def delete(self,customer_id):
         """
         Deletes a customer's shopcart
         """
         app.logger.info("Request to delete a shopcart for customer " + customer_id)
-        shopcarts = Shopcart.find_by_customer_id(customer_id).all()
-
-        message = [shopcart.serialize() for shopcart in shopcarts]
-    
-        for shopcart in shopcarts:
-            shopcart.delete()
-        
+        quantity_buffer.flush(customer_id)
+        message = Shopcart.delete_by_customer_id(customer_id)
         return message, status.HTTP_204_NO_CONTENT
         
 
@@ -152,21 +220,156 @@ class ShopcartCollection(Resource):
     #------------------------------------------------------------------
     @api.doc('list_shopcarts')
     @api.expect(shopcart_args, validate=True)
-    @api.marshal_list_with(shopcart_model)
+    @api.response(304, 'No shopcart modified since the ETag in If-None-Match')
+    @api.response(200, 'Success', [shopcart_model])
     def get(self):
         """
         Return all of the shopcarts
         """
         app.logger.info("Request for shopcarts list")
-        price_threshold = shopcart_args.parse_args().get('price')
-        shopcarts=[]
-        if price_threshold:
-            shopcarts = Shopcart.find_shopcart_items_price(price_threshold)
-        else:
-            shopcarts = Shopcart.all()
-        results=[shopcart.serialize() for shopcart in shopcarts]
+        args = shopcart_args.parse_args()
+        etag = make_etag("carts", CartVersion.total(), quantity_buffer.sequence(), request.query_string)
+        if is_not_modified(etag):
+            return not_modified(etag)
+        price_threshold = args.get('price')
+        limit = args.get('limit')
+        if limit or args.get('after'):
+            results, code, headers = list_shopcarts_page(price_threshold, limit, args.get('after'))
+            headers.update(etag_headers(etag))
+            return json_response(quantity_buffer.overlay(results), code, headers)
+        results = shopcart_encoder.dicts(Shopcart.read_all(price_threshold))
         app.logger.info("Returning %d shopcarts", len(results))
-        return results,status.HTTP_200_OK
+        return json_response(quantity_buffer.overlay(results), status.HTTP_200_OK, etag_headers(etag))
+
+
+######################################################################
+#  PATH: /shopcarts/{id}/summary
+######################################################################
+@api.route('/shopcarts/<customer_id>/summary')
+@api.param('customer_id', 'The Shopcart identifier')
+class ShopcartSummaryResource(Resource):
+    """ Totals of a single customer's shopcart """
+    @api.doc('get_shopcart_summary')
+    @api.response(404, 'Shopcart for the customer does not exist!')
+    @api.marshal_with(summary_model)
+    def get(self, customer_id):
+        """
+        Return the item count, total quantity and total value of a shopcart
+        """
+        app.logger.info("Request for the summary of the shopcart of customer %s", customer_id)
+        flush_quantities(customer_id)  # the totals are computed by the database
+        summaries = Shopcart.summarize([customer_id])
+        if not summaries:
+            abort(status.HTTP_404_NOT_FOUND, "Shopcart for the customer does not exist!")
+        return summaries[0], status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /shopcarts/summary
+######################################################################
+@api.route('/shopcarts/summary')
+class ShopcartSummaryCollection(Resource):
+    """ Totals of several customers' shopcarts """
+    @api.doc('list_shopcart_summaries')
+    @api.expect(summary_args, validate=True)
+    @api.marshal_list_with(summary_model)
+    def get(self):
+        """
+        Return the totals of the shopcarts of several customers
+        Customers with an empty shopcart are left out
+        """
+        customer_ids = summary_args.parse_args()['customer_id']
+        app.logger.info("Request for the summary of %d shopcarts", len(customer_ids))
+        flush_quantities(*customer_ids)  # the totals are computed by the database
+        return Shopcart.summarize(customer_ids), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /shopcarts/export
+######################################################################
+@api.route('/shopcarts/export')
+class ShopcartExport(Resource):
+    """ Streams every Shopcart item as newline-delimited JSON """
+    #------------------------------------------------------------------
+    # EXPORT ALL SHOPCARTS
+    #------------------------------------------------------------------
+    @api.doc('export_shopcarts')
+    @api.produces(['application/x-ndjson'])
+    def get(self):
+        """
+        Export all of the shopcarts as newline-delimited JSON
+        """
+        app.logger.info("Request to export all shopcarts")
+        batch_size = app.config["EXPORT_BATCH_SIZE"]
+
+        def generate():
+            lines = []
+            for row in shopcart_encoder.rows(Shopcart.stream_all(batch_size)):
+                lines.append(serializers.dumps(quantity_buffer.overlay_item(shopcart_encoder.to_dict(row))))
+                if len(lines) == batch_size:
+                    yield b"\n".join(lines) + b"\n"
+                    lines = []
+            if lines:
+                yield b"\n".join(lines) + b"\n"
+
+        return Response(stream_with_context(generate()), status=status.HTTP_200_OK,
+                        mimetype="application/x-ndjson")
+
+
+######################################################################
+#  PATH: /stats/cache
+######################################################################
+@api.route('/stats/cache')
+class CacheStatsResource(Resource):
+    """ Reports the cart cache of the worker that answers """
+    @api.doc('get_cache_stats')
+    def get(self):
+        """
+        Return the hit, miss and eviction counters of the cart cache
+        """
+        return cart_cache.stats(), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /stats/write-behind
+######################################################################
+@api.route('/stats/write-behind')
+class WriteBehindStatsResource(Resource):
+    """ Reports the quantity write-behind buffer of the worker that answers """
+    @api.doc('get_write_behind_stats')
+    def get(self):
+        """
+        Return the pending changes and flush counters of the quantity write-behind buffer
+        """
+        return quantity_buffer.stats(), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /stats/replicas
+######################################################################
+@api.route('/stats/replicas')
+class ReplicaStatsResource(Resource):
+    """ Reports where the worker that answers sends its reads """
+    @api.doc('get_replica_stats')
+    def get(self):
+        """
+        Return the number of reads sent to the primary and to the replicas
+        """
+        return replica_router.stats(), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /stats/pool
+######################################################################
+@api.route('/stats/pool')
+class PoolStatsResource(Resource):
+    """ Reports the database connection pool of the worker that answers """
+    @api.doc('get_pool_stats')
+    def get(self):
+        """
+        Return the checked out, overflow and wait time statistics of the connection pool
+        """
+        return pool_stats(db.engine.pool), status.HTTP_200_OK
 
 
 ######################################################################
@@ -181,6 +384,7 @@ class ProductResource(Resource):
     Allows the manipulation of a single customer's shopcart
     GET - Returns a customer's shopcart's product with the respective ids
     PUT - Updates the quantity for a customer's shopcart's product with the respective ids
+    PATCH - Adds a delta to the quantity of a customer's shopcart's product with the respective ids
     DELETE -  Deletes a customer's shopcart product with the respective ids
     """
     ######################################################################
@@ -188,33 +392,43 @@ class ProductResource(Resource):
     ######################################################################
     @api.doc('get_product_from_shopcart')
     @api.response(404, 'Product in shopcart not found')
+    @api.response(304, 'Product not modified since the ETag in If-None-Match')
     @api.marshal_with(shopcart_model)
     def get(self, customer_id,product_id):
         """
         Read a product from a shopcart
         """
         app.logger.info("Request to get a product from {}'s shopcart. ".format(customer_id))
-        product = Shopcart.find_by_shopcart_item(customer_id,product_id)
+        etag = make_etag("product", customer_id, product_id, Shopcart.find_cart_version(customer_id),
+                         quantity_buffer.sequence(customer_id))
+        if is_not_modified(etag):
+            return None, status.HTTP_304_NOT_MODIFIED, etag_headers(etag)
+        product = quantity_buffer.overlay_item(Shopcart.find_cart_item(customer_id,product_id))
         if not product:
             abort(status.HTTP_404_NOT_FOUND, "The product does not exist!")
-        target_product = product
         app.logger.info("Returning product with id: %s", product_id)
-        return target_product.serialize(), status.HTTP_200_OK
+        return product, status.HTTP_200_OK, etag_headers(etag)
 
     ######################################################################
     # UPDATE A SHOPCART 
     ######################################################################
-    @api.doc('update_product_in_shopcart')
+    @api.doc('update_product_in_shopcart', params=idempotency_key_param)
     @api.response(404, 'Product not found')
     @api.response(400, 'The posted shopcart data was not valid')
     @api.expect(shopcart_model,validate=True)
     @api.marshal_with(shopcart_model)
+    @idempotent
     def put(self, customer_id, product_id):
         """
         Update the quantity of an item in a Shopcart
         This endpoint will update a Shopcart based the body that is posted
         """
         app.logger.info("Request to update Shopcart for costomer_id: %s", customer_id)
+        if quantity_buffer.enabled:
+            message = buffer_quantity_update(customer_id, product_id, api.payload)
+            if message:
+                return message, status.HTTP_200_OK
+        quantity_buffer.flush(customer_id)
         shopcart = Shopcart.find_by_shopcart_item(customer_id, product_id)
         if not shopcart:
             abort(status.HTTP_404_NOT_FOUND, "ShopCart item for customer_id '{}' was not found.".format(customer_id))
@@ -224,16 +438,43 @@ class ProductResource(Resource):
         app.logger.info("Shopcart with custoemr_id [%s] updated.", shopcart.customer_id)
         return shopcart.serialize(), status.HTTP_200_OK
 
+    ######################################################################
+    # CHANGE THE QUANTITY OF A PRODUCT
+    ######################################################################
+    @api.doc('adjust_product_quantity_in_shopcart', params=idempotency_key_param)
+    @api.response(404, 'Product not found')
+    @api.response(400, 'The posted delta was not valid')
+    @api.expect(quantity_delta_model, validate=True)
+    @api.marshal_with(shopcart_model)
+    @idempotent
+    def patch(self, customer_id, product_id):
+        """
+        Add to or remove from the quantity of an item in a Shopcart
+        The change is applied atomically in the database, and the item is
+        removed from the Shopcart when its quantity reaches zero
+        """
+        app.logger.info("Request to change the quantity of product %s for customer_id: %s", product_id, customer_id)
+        if quantity_buffer.enabled:
+            shopcart = buffer_quantity_delta(customer_id, product_id, api.payload["delta"])
+        else:
+            shopcart = Shopcart.adjust_quantity(customer_id, product_id, api.payload["delta"])
+        if not shopcart:
+            abort(status.HTTP_404_NOT_FOUND, "ShopCart item for customer_id '{}' was not found.".format(customer_id))
+        app.logger.info("Quantity of product %s for customer_id [%s] is now %s", product_id, customer_id, shopcart["quantity"])
+        return shopcart, status.HTTP_200_OK
+
     ######################################################################
     # DELETE A PRODUCT FROM THE SHOPCART
     ######################################################################
-    @api.doc('delete_product_in_shopcart')
+    @api.doc('delete_product_in_shopcart', params=idempotency_key_param)
     @api.response(204, 'Product deleted')
+    @idempotent
     def delete(self, customer_id, product_id):
         """
         Delete a product from a shopcart
         """
         app.logger.info("Request to delete a product from {}'s shopcart. ".format(customer_id))
+        quantity_buffer.flush(customer_id)
         product = Shopcart.find_by_shopcart_item(customer_id,product_id)
         if product:
             product.delete()
@@ -253,17 +494,30 @@ class ProductCollection(Resource):
     ######################################################################
     # ADD A PRODUCT
     ######################################################################
-    @api.doc('add_product_in_shopcart')
+    @api.doc('add_product_in_shopcart', params=idempotency_key_param)
     @api.response(400, 'The posted data was not valid')
-    @api.expect(shopcart_model,validate=True)
-    @api.marshal_with(shopcart_model, code=201)
+    @api.response(201, 'Product added', shopcart_model)
+    @api.response(200, 'Product merged into the one already in the shopcart', shopcart_model)
+    @api.expect(product_args, shopcart_model, validate=False)
+    @idempotent
     def post(self, customer_id):
             """
             Add a product into the shopcart
+            A JSON array of products is added in a single transaction and
+            answered with a ShopcartBatchResult listing the created products
+            and the ones that already existed
+            With merge=true the quantity is added to a product already in the
+            shopcart, and X-Upsert-Result tells whether it was inserted or merged
             """
+            quantity_buffer.flush(customer_id)
+            if isinstance(api.payload, list):
+                return add_products_batch(customer_id, api.payload)
+            shopcart_model.validate(api.payload)
             app.logger.info("Request to add a product into the shopcart")
             shopcart = Shopcart()
             shopcart.deserialize(api.payload)
+            if product_args.parse_args().get('merge'):
+                return merge_product(shopcart)
             product = shopcart.find_by_shopcart_item(customer_id,shopcart.product_id)
             if product:
                 abort(status.HTTP_400_BAD_REQUEST, 'Product already exist!')
@@ -271,7 +525,7 @@ class ProductCollection(Resource):
             message = shopcart.serialize()
             app.logger.info("Product with id [%s] added in to the customer: [%s]'s shopcart.",shopcart.product_id, shopcart.customer_id)
 
-            return message, status.HTTP_201_CREATED
+            return marshal(message, shopcart_model), status.HTTP_201_CREATED
 
 
 ######################################################################
@@ -284,30 +538,166 @@ class CheckoutResource(Resource):
     # ACTION: CUSTOMER CHECKOUT
     ######################################################################
     @api.doc('checkout_customer')
+    @api.doc(params=idempotency_key_param)
     @api.response(404, 'Customer not found')
     @api.marshal_list_with(shopcart_model)
+    @idempotent
     def put(self, customer_id):
         """
         Checkout a customer
+        The items are removed and returned in a single transaction. With an
+        Idempotency-Key header, a retry of the checkout returns the items of
+        the first one and Idempotent-Replayed: true
         """
         app.logger.info("Request to create a checkout event for customer {0}.".format(customer_id))
-        shopcarts = Shopcart.find_by_customer_id(customer_id).all()
-        
-        if not shopcarts:
+        quantity_buffer.flush(customer_id)
+        message = Shopcart.checkout(customer_id)
+        if not message:
             abort(status.HTTP_404_NOT_FOUND, 'Shopcart with id [{}] was not found.'.format(customer_id))
-       
-        message = [shopcart.serialize() for shopcart in shopcarts]
-        
-        for shopcart in shopcarts:
-            shopcart.delete()
         return message, status.HTTP_200_OK
 
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
+def merge_product(shopcart):
+    """ Adds a product to a shopcart, merging its quantity into an existing one """
+    message, inserted = shopcart.upsert()
+    result = "inserted" if inserted else "merged"
+    app.logger.info("Product with id [%s] %s in to the customer: [%s]'s shopcart.", shopcart.product_id, result, shopcart.customer_id)
+    code = status.HTTP_201_CREATED if inserted else status.HTTP_200_OK
+    return marshal(message, shopcart_model), code, {"X-Upsert-Result": result}
+
+
+def flush_quantities(*customer_ids):
+    """ Writes the buffered quantity changes of customers, and reads them back from the primary """
+    for customer_id in customer_ids:
+        quantity_buffer.flush(customer_id)
+    if quantity_buffer.enabled:
+        # the replicas may not have the changes yet, even those the background flush wrote
+        g.read_bind = None
+
+
+def buffer_quantity_delta(customer_id, product_id, delta):
+    """
+    Adds delta to the quantity of a product through the write-behind buffer
+    A product whose quantity drops to zero is removed from the database right away
+    """
+    item = quantity_buffer.overlay_item(Shopcart.find_cart_item(customer_id, product_id))
+    if item is None:
+        return None
+    quantity = (item["quantity"] or 0) + delta
+    if quantity <= 0:
+        quantity_buffer.flush(customer_id)
+        return Shopcart.adjust_quantity(customer_id, product_id, delta)
+    quantity_buffer.add(customer_id, product_id, delta)
+    return dict(item, quantity=quantity)
+
+
+def buffer_quantity_update(customer_id, product_id, payload):
+    """
+    Buffers an update that only changes the quantity of a product in the shopcart
+    Returns None, and buffers nothing, for any other update
+    """
+    item = quantity_buffer.overlay_item(Shopcart.find_cart_item(customer_id, product_id))
+    if item is None:
+        return None
+    update = Shopcart().deserialize(payload).serialize()
+    if any(update[key] != item[key] for key in update if key != "quantity"):
+        return None
+    quantity_buffer.set(customer_id, product_id, update["quantity"])
+    return update
+
+
+def add_products_batch(customer_id, payload):
+    """ Adds a batch of products to a shopcart in one transaction and reports the conflicts """
+    app.logger.info("Request to add %d products into the shopcart of customer %s", len(payload), customer_id)
+    if not payload:
+        raise DataValidationError("Invalid Shopcart: body of request contained no products")
+    for item in payload:
+        shopcart_model.validate(item)
+    shopcarts = [Shopcart().deserialize(item) for item in payload]
+    for shopcart in shopcarts:
+        if str(shopcart.customer_id) != str(customer_id):
+            raise DataValidationError(
+                "Invalid Shopcart: product {} belongs to customer {}, not {}".format(
+                    shopcart.product_id, shopcart.customer_id, customer_id)
+            )
+    created, conflicts = Shopcart.create_many(shopcarts)
+    app.logger.info("Added %d products, %d already existed", len(created), len(conflicts))
+    message = {
+        "created": [shopcart.serialize() for shopcart in created],
+        "conflicts": [shopcart.serialize() for shopcart in conflicts]
+    }
+    return marshal(message, shopcart_batch_model), status.HTTP_201_CREATED
+
+
+def list_shopcarts_page(price_threshold, limit, after):
+    """ Returns one keyset page of shopcarts and the headers pointing at the next one """
+    limit = min(limit or app.config["DEFAULT_PAGE_SIZE"], app.config["MAX_PAGE_SIZE"])
+    shopcarts = Shopcart.read_page(limit, decode_cursor(after), price_threshold)
+    results = shopcart_encoder.dicts(shopcarts)
+    headers = {}
+    if len(shopcarts) == limit:
+        cursor = encode_cursor(shopcarts[-1])
+        headers["X-Next-Cursor"] = cursor
+        next_args = {"limit": limit, "after": cursor}
+        if price_threshold is not None:
+            next_args["price"] = price_threshold
+        headers["Link"] = '<{}>; rel="next"'.format(url_for("shopcart_collection", **next_args))
+    app.logger.info("Returning page of %d shopcarts", len(results))
+    return results, status.HTTP_200_OK, headers
+
+
+def make_etag(*parts):
+    """ Returns a strong ETag for the representation that parts identify """
+    return hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:24]
+
+
+def etag_headers(etag):
+    """ Returns the headers that make clients revalidate a response with its ETag """
+    return {"ETag": quote_etag(etag), "Cache-Control": "no-cache"}
+
+
+def is_not_modified(etag):
+    """ Tells if the client already has the representation, plain or compressed """
+    return any(variant in request.if_none_match for variant in etag_variants(etag))
+
+
+def not_modified(etag):
+    """ Returns an empty 304 response for a representation the client already has """
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers=etag_headers(etag))
+
+
+def encode_cursor(shopcart):
+    """ Encodes the primary key of a shopcart item as a page cursor """
+    return "{}:{}".format(shopcart.customer_id, shopcart.product_id)
+
+
+def decode_cursor(cursor):
+    """ Decodes a page cursor into a (customer_id, product_id) key """
+    if not cursor:
+        return None
+    try:
+        customer_id, product_id = cursor.split(":")
+        return int(customer_id), int(product_id)
+    except ValueError:
+        raise DataValidationError("Invalid cursor: " + cursor)
+
+
 def init_db():
     """ Initialies the SQLAlchemy app """
     global app
+    serializers.configure(app.config["JSON_BACKEND"])
     Shopcart.init_db(app)
 
+
+
+######################################################################
+#  C O M M A N D S
+######################################################################
+@app.cli.command("db-init")
+def db_init():
+    """ Creates the missing tables and runs the migrations, once per deploy """
+    Shopcart.create_schema()
+    click.echo("Database schema is up to date")
@@ -0,0 +1,224 @@
+"""
+Write-behind buffer of shopcart quantity changes
+
+When customers click + and - many times a second, every click would be
+its own UPDATE and commit. With the buffer enabled, each worker keeps the
+pending change of every (customer_id, product_id) in memory instead, and
+writes them all with a few batched statements every interval seconds, as
+soon as max_pending items are waiting, and when the worker exits.
+
+Relative changes stay relative until they are written, so buffered deltas
+from several workers add up in the database instead of overwriting each
+other. An absolute quantity is written as it was set, and overwrites any
+change another worker committed to the item in the meantime.
+
+The worker that buffered a change overlays it on what it reads, until the
+flush that writes it has committed, so its clients see their own writes.
+Other workers see them once they are flushed, up to interval seconds
+later.
+"""
+import os
+import atexit
+import logging
+import threading
+from contextlib import nullcontext
+
+logger = logging.getLogger("flask.app")
+
+
+def _merge(older, newer):
+    """ Returns the change that applying older and then newer amounts to """
+    if newer["quantity"] is not None:
+        return newer
+    if older["quantity"] is not None:
+        return {"quantity": older["quantity"] + newer["delta"], "delta": 0}
+    return {"quantity": None, "delta": older["delta"] + newer["delta"]}
+
+
+def _customer(customer_id):
+    """ Returns a customer_id as an int, or None for one that is not a number """
+    try:
+        return int(customer_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class QuantityBuffer:
+    """
+    Pending quantity changes by (customer_id, product_id)
+    A change either sets the quantity, or adds a delta to the quantity in
+    the database when quantity is None
+    """
+
+    def __init__(self, enabled=False, interval=0.5, max_pending=1000):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._flushing = {}
+        self._sequences = {}
+        self._sequence = 0
+        self._apply = None
+        self._on_written = None
+        self._context = nullcontext
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.flushes = 0
+        self.written = 0
+        self.configure(enabled, interval, max_pending)
+        atexit.register(self.close)
+
+    def configure(self, enabled, interval, max_pending, apply=None, context=None, on_written=None):
+        """
+        Changes the settings of the buffer
+        Args:
+            apply (callable): writes a list of (customer_id, product_id, quantity, delta) in one transaction
+            context (callable): returns the context the background flushes run in
+            on_written (callable): called with each customer_id whose changes were written
+        """
+        self.enabled = enabled
+        self.interval = interval
+        self.max_pending = max_pending
+        if apply is not None:
+            self._apply = apply
+        if on_written is not None:
+            self._on_written = on_written
+        if context is not None:
+            self._context = context
+
+    def add(self, customer_id, product_id, delta):
+        """ Buffers adding delta to the quantity of an item """
+        self._buffer(customer_id, product_id, {"quantity": None, "delta": delta})
+
+    def set(self, customer_id, product_id, quantity):
+        """ Buffers setting the quantity of an item """
+        self._buffer(customer_id, product_id, {"quantity": quantity, "delta": 0})
+
+    def _buffer(self, customer_id, product_id, change):
+        key = (int(customer_id), int(product_id))
+        with self._lock:
+            older = self._pending.get(key)
+            self._pending[key] = _merge(older, change) if older else change
+            self._sequence += 1
+            self._sequences[key[0]] = self._sequence
+            full = len(self._pending) >= self.max_pending
+        self._start()
+        if full:
+            self.flush()
+
+    def sequence(self, customer_id=None):
+        """ Returns a number that changes with every change buffered for a customer, or for anyone """
+        if customer_id is None:
+            return self._sequence
+        return self._sequences.get(_customer(customer_id), 0)
+
+    def overlay(self, items):
+        """ Returns serialized shopcart items with the pending changes applied, without changing them """
+        if not self._pending and not self._flushing:
+            return items
+        return [self.overlay_item(item) for item in items]
+
+    def overlay_item(self, item):
+        """ Returns a serialized shopcart item with its pending change applied """
+        if item is None or not (self._pending or self._flushing):
+            return item
+        key = (item["customer_id"], item["product_id"])
+        with self._lock:
+            # a change being written is not committed yet, so it still applies
+            flushing, pending = self._flushing.get(key), self._pending.get(key)
+        if flushing is None and pending is None:
+            return item
+        change = _merge(flushing, pending) if flushing and pending else flushing or pending
+        if change["quantity"] is not None:
+            return dict(item, quantity=change["quantity"])
+        return dict(item, quantity=(item["quantity"] or 0) + change["delta"])
+
+    def flush(self, customer_id=None):
+        """
+        Writes the pending changes of a customer, or of everyone
+        Returns:
+            int: the number of items written
+        """
+        if not self._pending:
+            return 0
+        if customer_id is not None:
+            customer_id = _customer(customer_id)
+            if customer_id is None:
+                return 0  # nothing is buffered for a customer_id that is not a number
+        with self._flush_lock:
+            with self._lock:
+                if customer_id is None:
+                    changes, self._pending = self._pending, {}
+                else:
+                    changes = {key: change for key, change in self._pending.items() if key[0] == customer_id}
+                    for key in changes:
+                        del self._pending[key]
+                self._flushing = changes
+            if not changes:
+                return 0
+            try:
+                self._apply([key + (change["quantity"], change["delta"]) for key, change in changes.items()])
+            except Exception:
+                # keep the changes, under any made since they were taken
+                with self._lock:
+                    for key, change in changes.items():
+                        newer = self._pending.get(key)
+                        self._pending[key] = _merge(change, newer) if newer else change
+                    self._flushing = {}
+                raise
+            customers = {key[0] for key in changes}
+            with self._lock:
+                self._flushing = {}
+                for customer in customers:
+                    if not any(key[0] == customer for key in self._pending):
+                        self._sequences.pop(customer, None)
+            if self._on_written is not None:
+                for customer in customers:
+                    self._on_written(customer)
+            self.flushes += 1
+            self.written += len(changes)
+        return len(changes)
+
+    def _start(self):
+        """ Starts the background flushes of this process if they are not running """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # a forked worker inherits the object but not the thread
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="quantity-buffer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                with self._context():
+                    self.flush()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Writing buffered quantities failed, retrying in %s seconds", self.interval)
+
+    def close(self):
+        """ Stops the background flushes and writes what is still pending """
+        self._stopped.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(self.interval + 1)
+        if self._pending:
+            try:
+                with self._context():
+                    self.flush()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Writing %d buffered quantities failed, they are lost", len(self._pending))
+
+    def stats(self):
+        """ Returns the counters and settings of the buffer """
+        return {
+            "enabled": self.enabled,
+            "interval": self.interval,
+            "max_pending": self.max_pending,
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "written": self.written,
+        }
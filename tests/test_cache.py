@@ -0,0 +1,80 @@
+"""
+Test cases for the cart cache
+
+"""
+import unittest
+from services.cache import CartCache
+
+
+class FakeClock:
+    """ A clock that only moves when told to """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+######################################################################
+#  C A R T   C A C H E   T E S T   C A S E S
+######################################################################
+class TestCartCache(unittest.TestCase):
+    """ Test Cases for the CartCache """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.clock = FakeClock()
+        self.cache = CartCache(enabled=True, maxsize=2, ttl=10, clock=self.clock)
+
+    def test_hit_and_miss(self):
+        """ Read a cached value and a missing one """
+        self.assertIsNone(self.cache.get(1))
+        self.cache.put(1, ["a"], self.cache.token())
+        self.assertEqual(self.cache.get("1"), ["a"])
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_least_recently_used_is_evicted(self):
+        """ Evict the least recently used value when full """
+        self.cache.put(1, ["a"], self.cache.token())
+        self.cache.put(2, ["b"], self.cache.token())
+        self.cache.get(1)
+        self.cache.put(3, ["c"], self.cache.token())
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), ["a"])
+        self.assertEqual(self.cache.get(3), ["c"])
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_value_expires(self):
+        """ Forget a value once its time-to-live is over """
+        self.cache.put(1, ["a"], self.cache.token())
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_invalidate(self):
+        """ Invalidate a value and refuse values read before a write """
+        token = self.cache.token()
+        self.cache.put(1, ["a"], token)
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.put(1, ["stale"], token)
+        self.assertIsNone(self.cache.get(1))
+
+    def test_numeric_keys(self):
+        """ Cache a customer_id under the same key however it is written """
+        self.cache.put("007", ["a"], self.cache.token())
+        self.assertEqual(self.cache.get(7), ["a"])
+        self.cache.invalidate("7")
+        self.assertIsNone(self.cache.get("007"))
+        self.cache.put("abc", ["b"], self.cache.token())
+        self.assertEqual(self.cache.get("abc"), ["b"])
+
+    def test_disabled(self):
+        """ Cache nothing when disabled """
+        self.cache.configure(False, 2, 10)
+        self.cache.put(1, ["a"], self.cache.token())
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()["misses"], 0)
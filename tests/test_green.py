@@ -0,0 +1,50 @@
+"""
+Test cases for the cooperative (gevent) entry point
+
+Importing services.green monkey patches the whole interpreter, so every
+test imports it in a child process of its own.
+"""
+import os
+import sys
+import subprocess
+import unittest
+from importlib.util import find_spec
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(code):
+    """ Runs Python code in a new interpreter and returns its exit code and output """
+    env = dict(os.environ, DATABASE_URI="sqlite://", DB_CREATE_SCHEMA="false")
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return result.returncode, result.stdout.decode()
+
+
+######################################################################
+#  G R E E N   E N T R Y   P O I N T   T E S T   C A S E S
+######################################################################
+class TestGreen(unittest.TestCase):
+    """ Test Cases for services.green """
+
+    @unittest.skipUnless(find_spec("gevent") and find_spec("psycogreen"), "gevent and psycogreen are not installed")
+    def test_patched_app(self):
+        """ Serve services:app with the standard library and psycopg2 made cooperative """
+        code, output = run(
+            "import services.green, services, psycopg2.extensions\n"
+            "from gevent import monkey\n"
+            "assert monkey.is_module_patched('socket')\n"
+            "assert psycopg2.extensions.get_wait_callback() is not None\n"
+            "assert services.green.app is services.app\n"
+        )
+        self.assertEqual(code, 0, output)
+
+    def test_without_gevent(self):
+        """ Fail to import without gevent instead of serving unpatched """
+        code, output = run(
+            "import sys\n"
+            "sys.modules['gevent'] = None\n"
+            "import services.green\n"
+        )
+        self.assertNotEqual(code, 0)
+        self.assertIn("ModuleNotFoundError", output)
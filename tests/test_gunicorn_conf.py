@@ -0,0 +1,50 @@
+"""
+Test cases for the gunicorn settings
+
+"""
+import os
+import runpy
+import unittest
+from unittest.mock import patch
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gunicorn.conf.py")
+
+
+def load(**environ):
+    """ Returns the settings that gunicorn.conf.py makes of an environment """
+    with patch.dict(os.environ, environ):
+        return runpy.run_path(CONFIG)
+
+
+######################################################################
+#  G U N I C O R N   S E T T I N G S   T E S T   C A S E S
+######################################################################
+class TestGunicornConf(unittest.TestCase):
+    """ Test Cases for gunicorn.conf.py """
+
+    def test_sync_by_default(self):
+        """ Serve with preloaded sync workers by default """
+        settings = load(PORT="5000")
+        self.assertEqual(settings["worker_class"], "sync")
+        self.assertEqual(settings["workers"], 2 * settings["cpus"] + 1)
+        self.assertEqual(settings["bind"], "0.0.0.0:5000")
+        self.assertEqual(settings["wsgi_app"], "services:app")
+        self.assertTrue(settings["preload_app"])
+        self.assertEqual(settings["max_requests_jitter"], settings["max_requests"] // 10)
+
+    def test_gthread(self):
+        """ Serve with threads """
+        settings = load(GUNICORN_WORKER_CLASS="gthread", GUNICORN_THREADS="8", GUNICORN_WORKERS="3")
+        self.assertEqual(settings["threads"], 8)
+        self.assertEqual(settings["workers"], 3)
+
+    def test_gevent(self):
+        """ Serve the cooperative app with gevent, never preloaded """
+        settings = load(GUNICORN_WORKER_CLASS="gevent", GUNICORN_PRELOAD="true")
+        self.assertEqual(settings["wsgi_app"], "services.green:app")
+        self.assertFalse(settings["preload_app"])
+        self.assertEqual(settings["threads"], 1)
+
+    def test_unknown_worker_class(self):
+        """ Refuse a worker class that is not supported """
+        self.assertRaises(ValueError, load, GUNICORN_WORKER_CLASS="eventlet")
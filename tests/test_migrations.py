@@ -0,0 +1,91 @@
+"""
+Test cases for the schema migrations
+
+"""
+import unittest
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Float, Integer, MetaData, String, Table, Text, create_engine, inspect
+from services import migrations
+
+
+######################################################################
+#  M I G R A T I O N   T E S T   C A S E S
+######################################################################
+class TestMigrations(unittest.TestCase):
+    """ Test Cases for the schema migrations """
+
+    def setUp(self):
+        """ This runs before each test """
+        # a database created before the indexes were declared on the model
+        self.engine = create_engine("sqlite://")
+        Table(
+            "shopcart",
+            MetaData(),
+            Column("customer_id", Integer, primary_key=True),
+            Column("product_id", Integer, primary_key=True),
+            Column("product_name", String(64), nullable=False),
+            Column("product_price", Float, nullable=False),
+            Column("quantity", Integer),
+        ).create(self.engine)
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.engine.dispose()
+
+    def test_upgrade_existing_database(self):
+        """ Upgrade a database that has none of the migrations """
+        migrations.upgrade(self.engine)
+        indexes = {index["name"] for index in inspect(self.engine).get_indexes("shopcart")}
+        self.assertIn("ix_shopcart_product_price", indexes)
+        self.assertIn("ix_shopcart_customer_id_product_price", indexes)
+        self.assertIn("ix_shopcart_product_id", indexes)
+        with self.engine.connect() as connection:
+            self.assertEqual(migrations.current_version(connection), migrations.MIGRATIONS[-1][0])
+
+    def test_upgrade_is_idempotent(self):
+        """ Upgrade a database twice """
+        migrations.upgrade(self.engine)
+        migrations.upgrade(self.engine)
+        with self.engine.connect() as connection:
+            versions = connection.execute(migrations.schema_version.select()).fetchall()
+        self.assertEqual(len(versions), len(migrations.MIGRATIONS))
+
+    def test_add_idempotency_fingerprints(self):
+        """ Add the fingerprint columns to the idempotency keys of checkouts """
+        keys = Table(
+            "idempotency_key",
+            MetaData(),
+            Column("key", String(255), primary_key=True),
+            Column("customer_id", Integer, nullable=False),
+            Column("response", Text, nullable=False),
+            Column("created_at", DateTime, nullable=False),
+        )
+        keys.create(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(keys.insert().values(key="a", customer_id=1, response="[]", created_at=datetime(2021, 1, 1)))
+        migrations.upgrade(self.engine)
+        columns = {column["name"] for column in inspect(self.engine).get_columns("idempotency_key")}
+        self.assertTrue({"fingerprint", "status_code", "headers", "claimed_at"} <= columns)
+        indexes = {index["name"] for index in inspect(self.engine).get_indexes("idempotency_key")}
+        self.assertIn("ix_idempotency_key_created_at", indexes)
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.execute("SELECT status_code FROM idempotency_key").scalar(), 200)
+            self.assertIsNotNone(connection.execute("SELECT claimed_at FROM idempotency_key").scalar())
+
+    def test_number_cart_versions(self):
+        """ Index the versions and start the highest one from their sum """
+        versions = Table(
+            "cart_version",
+            MetaData(),
+            Column("customer_id", Integer, primary_key=True, autoincrement=False),
+            Column("version", Integer, nullable=False),
+        )
+        versions.create(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(versions.insert(), [{"customer_id": 1, "version": 3}, {"customer_id": 2, "version": 4}])
+        migrations.upgrade(self.engine)
+        indexes = {index["name"] for index in inspect(self.engine).get_indexes("cart_version")}
+        self.assertIn("ix_cart_version_version", indexes)
+        with self.engine.connect() as connection:
+            rows = connection.execute("SELECT customer_id, version FROM cart_version ORDER BY customer_id").fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(1, 3), (2, 7)])
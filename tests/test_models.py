@@ -5,7 +5,12 @@ Test cases for YourResourceModel Model
 import logging
 import unittest
 import os
-from services.models import Shopcart, DataValidationError, db
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from services.models import (
+    Shopcart, CartVersion, DataValidationError, IdempotencyKey, IdempotencyKeyReusedError, RequestInProgressError, db,
+    dispose_engine
+)
 from tests.factories import ShopcartFactory
 from services import app
 from werkzeug.exceptions import NotFound
@@ -84,6 +89,41 @@ class TestShopcart(unittest.TestCase):
         self.assertEqual(product.product_id, shopcart.product_id)
         self.assertEqual(product.quantity, 3)
 
+    def test_create_many_shopcarts(self):
+        """ Create a batch of Shopcart items in one statement """
+        Shopcart(customer_id=123, product_id=231, product_name="a",product_price=23.1,quantity=1).create()
+        created, conflicts = Shopcart.create_many([
+            Shopcart(customer_id=123, product_id=231, product_name="a",product_price=23.1,quantity=1),
+            Shopcart(customer_id=123, product_id=232, product_name="b",product_price=25,quantity=2),
+            Shopcart(customer_id=124, product_id=231, product_name="a",product_price=23.1,quantity=3),
+        ])
+        self.assertEqual([(s.customer_id, s.product_id) for s in created], [(123, 232), (124, 231)])
+        self.assertEqual([(s.customer_id, s.product_id) for s in conflicts], [(123, 231)])
+        self.assertEqual(len(Shopcart.all()), 3)
+        self.assertEqual(Shopcart.find_by_shopcart_item(124, 231).quantity, 3)
+
+    def test_adjust_quantity(self):
+        """ Add to and remove from the quantity of a Shopcart item """
+        Shopcart(customer_id=123, product_id=231, product_name="a",product_price=23.1,quantity=1).create()
+        item = Shopcart.adjust_quantity(123, 231, 2)
+        self.assertEqual(item["quantity"], 3)
+        self.assertEqual(item["product_name"], "a")
+        self.assertEqual(Shopcart.find_by_shopcart_item(123, 231).quantity, 3)
+        item = Shopcart.adjust_quantity(123, 231, -5)
+        self.assertEqual(item["quantity"], 0)
+        self.assertIsNone(Shopcart.find_by_shopcart_item(123, 231))
+        self.assertIsNone(Shopcart.adjust_quantity(123, 231, 1))
+
+    def test_upsert_shopcart(self):
+        """ Insert a Shopcart item, then merge its quantity into the existing one """
+        item, inserted = Shopcart(customer_id=123, product_id=231, product_name="a",product_price=23.1,quantity=1).upsert()
+        self.assertTrue(inserted)
+        self.assertEqual(item["quantity"], 1)
+        item, inserted = Shopcart(customer_id=123, product_id=231, product_name="a",product_price=23.1,quantity=2).upsert()
+        self.assertFalse(inserted)
+        self.assertEqual(item["quantity"], 3)
+        self.assertEqual(Shopcart.find_by_shopcart_item(123, 231).quantity, 3)
+
     def test_delete_shopcart(self):
         fake_shopcart = ShopcartFactory()
         logging.debug(fake_shopcart)
@@ -94,6 +134,113 @@ class TestShopcart(unittest.TestCase):
         fake_shopcart.delete()
         self.assertEqual(len(fake_shopcart.all()), 0)
 
+    def test_delete_by_customer_id(self):
+        """ Delete every item of a customer's Shopcart at once """
+        Shopcart(customer_id=123, product_id=231, product_name="a",product_price=23.1,quantity=1).create()
+        Shopcart(customer_id=123, product_id=232, product_name="b",product_price=25,quantity=2).create()
+        Shopcart(customer_id=124, product_id=231, product_name="a",product_price=23.1,quantity=3).create()
+        removed = Shopcart.delete_by_customer_id(123)
+        self.assertEqual(sorted(item["product_id"] for item in removed), [231, 232])
+        self.assertEqual(removed[0]["customer_id"], 123)
+        self.assertEqual(Shopcart.find_by_customer_id(123).count(), 0)
+        self.assertEqual(Shopcart.find_by_customer_id(124).count(), 1)
+        self.assertEqual(Shopcart.delete_by_customer_id(123), [])
+
+    def test_checkout(self):
+        """ Check out a Shopcart """
+        Shopcart(customer_id=123, product_id=231, product_name="a",product_price=23.1,quantity=1).create()
+        Shopcart(customer_id=123, product_id=232, product_name="b",product_price=25,quantity=2).create()
+        items = Shopcart.checkout(123)
+        self.assertEqual(sorted(item["product_id"] for item in items), [231, 232])
+        self.assertEqual(Shopcart.find_by_customer_id(123).count(), 0)
+        self.assertEqual(Shopcart.checkout(123), [])
+        self.assertEqual(Shopcart.checkout(124), [])
+
+    def test_idempotency_key(self):
+        """ Claim an idempotency key, store its response and let it expire """
+        self.assertRaises(DataValidationError, IdempotencyKey.reserve, "k" * 256, 123, "fingerprint-1")
+        claim, claimed = IdempotencyKey.reserve("key-1", 123, "fingerprint-1")
+        self.assertTrue(claimed)
+        stored, claimed = IdempotencyKey.reserve("key-1", 123, "fingerprint-1")
+        self.assertFalse(claimed)
+        self.assertRaises(RequestInProgressError, stored.replay, "fingerprint-1")
+        claim.complete(201, {"quantity": 1}, {"X-Upsert-Result": "inserted"})
+        self.assertEqual(IdempotencyKey.find("key-1").replay("fingerprint-1"),
+                         ({"quantity": 1}, 201, {"X-Upsert-Result": "inserted"}))
+        self.assertRaises(IdempotencyKeyReusedError, IdempotencyKey.find("key-1").replay, "fingerprint-2")
+        # a released key can be claimed again
+        claim, claimed = IdempotencyKey.reserve("key-2", 123, "fingerprint-1")
+        claim.release()
+        self.assertIsNone(IdempotencyKey.find("key-2"))
+        # expired keys are forgotten and deleted
+        IdempotencyKey._last_eviction = None
+        self.addCleanup(setattr, IdempotencyKey, "ttl", IdempotencyKey.ttl)
+        IdempotencyKey.ttl = 0
+        self.assertIsNone(IdempotencyKey.find("key-1"))
+        self.assertEqual(IdempotencyKey.evict_expired(), 1)
+        self.assertEqual(IdempotencyKey.evict_expired(), 0)
+
+    def test_claim_never_completed(self):
+        """ Take over the idempotency key of a request that died before it completed """
+        claim, claimed = IdempotencyKey.reserve("key-1", 123, "fingerprint-1")
+        Shopcart(customer_id=123, product_id=231, product_name="a", product_price=23.1, quantity=1).create()
+        # the worker dies: its changes were never committed
+        db.session.rollback()
+        db.session.info.pop(IdempotencyKey.DEFERRED)
+        self.assertEqual(Shopcart.all(), [])
+        stored, claimed = IdempotencyKey.reserve("key-1", 123, "fingerprint-1")
+        self.assertFalse(claimed)
+        IdempotencyKey.query.filter_by(key="key-1").update(
+            {"claimed_at": datetime.utcnow() - timedelta(seconds=IdempotencyKey.lease + 1)}
+        )
+        db.session.commit()
+        # another request with the key is still refused
+        self.assertFalse(IdempotencyKey.reserve("key-1", 123, "fingerprint-2")[1])
+        retry, claimed = IdempotencyKey.reserve("key-1", 123, "fingerprint-1")
+        self.assertTrue(claimed)
+        Shopcart(customer_id=123, product_id=231, product_name="a", product_price=23.1, quantity=1).create()
+        retry.complete(201, {"quantity": 1})
+        self.assertEqual(len(Shopcart.all()), 1)
+        self.assertEqual(IdempotencyKey.find("key-1").replay("fingerprint-1"), ({"quantity": 1}, 201, {}))
+        # the first request cannot complete a claim it lost
+        self.assertRaises(RequestInProgressError, claim.complete, 201, {"quantity": 1})
+
+    def test_cart_version(self):
+        """ Count the changes made to a Shopcart """
+        self.assertEqual(CartVersion.find(123), 0)
+        self.assertEqual(CartVersion.total(), 0)
+        shopcart = Shopcart(customer_id=123, product_id=231, product_name="a",product_price=23.1,quantity=1)
+        shopcart.create()
+        versions = [CartVersion.find(123)]
+        shopcart.quantity = 2
+        shopcart.update()
+        versions.append(CartVersion.find(123))
+        Shopcart.adjust_quantity(123, 231, 1)
+        versions.append(CartVersion.find(123))
+        Shopcart.delete_by_customer_id(123)
+        versions.append(CartVersion.find(123))
+        # an empty shopcart did not change
+        Shopcart.delete_by_customer_id(123)
+        self.assertEqual(CartVersion.find(123), versions[-1])
+        self.assertEqual(versions, sorted(set(versions)))
+        self.assertEqual(CartVersion.total(), versions[-1])
+        Shopcart(customer_id=124, product_id=231, product_name="a",product_price=23.1,quantity=1).create()
+        self.assertGreater(CartVersion.find(124), versions[-1])
+        self.assertEqual(CartVersion.total(), CartVersion.find(124))
+
+    def test_summarize(self):
+        """ Summarize Shopcarts in SQL """
+        Shopcart(customer_id=123, product_id=231, product_name="a",product_price=0.1,quantity=3).create()
+        Shopcart(customer_id=123, product_id=232, product_name="b",product_price=0.2,quantity=1).create()
+        Shopcart(customer_id=124, product_id=231, product_name="a",product_price=10,quantity=2).create()
+        summaries = Shopcart.summarize([123, 124, 125])
+        self.assertEqual(len(summaries), 2)
+        self.assertEqual(summaries[0]["customer_id"], 123)
+        self.assertEqual(summaries[0]["item_count"], 2)
+        self.assertEqual(summaries[0]["total_quantity"], 4)
+        self.assertEqual(str(summaries[0]["total_value"]), "0.50")
+        self.assertEqual(str(summaries[1]["total_value"]), "20.00")
+
     def test_serialize_shopcart(self):
         """ Test serialization of a Shopcart """
         shopcart = ShopcartFactory()
@@ -169,6 +316,14 @@ class TestShopcart(unittest.TestCase):
         self.assertRaises(DataValidationError, shopcart.deserialize, bad_shopcart3)
         self.assertRaises(DataValidationError, shopcart.deserialize, bad_shopcart4)
 
+    def test_deserialize_price_with_cents(self):
+        """ Refuse prices that would be rounded to cents """
+        data = {"customer_id": 1, "product_id": 1, "product_name": "a", "product_price": 10.01, "quantity": 1}
+        self.assertEqual(Shopcart().deserialize(data).product_price, 10.01)
+        self.assertEqual(Shopcart().deserialize(dict(data, product_price=30)).product_price, 30)
+        for price in (10.001, 0.1 + 0.2, float("nan"), True):
+            self.assertRaises(DataValidationError, Shopcart().deserialize, dict(data, product_price=price))
+
     def test_find_shopcart_item_by_price_by_customer_id(self):
         """ Find Shopcart items above a price for a customer"""
         Shopcart(customer_id=123, product_id=231, product_name="a",product_price=102.1,quantity=1).create()
@@ -200,3 +355,49 @@ class TestShopcart(unittest.TestCase):
         self.assertEqual(shopcart.product_name, "b")
         self.assertEqual(shopcart.product_price, 106)
         self.assertEqual(shopcart.quantity, 2)
+
+    def test_read_rows(self):
+        """ Read Shopcart items as plain rows """
+        Shopcart(customer_id=123, product_id=231, product_name="a",product_price=10.1,quantity=1).create()
+        Shopcart(customer_id=123, product_id=233, product_name="a",product_price=102.1,quantity=3).create()
+        Shopcart(customer_id=121, product_id=232, product_name="b",product_price=106,quantity=2).create()
+        self.assertEqual(len(Shopcart.read_all()), 3)
+        self.assertEqual(sorted(row.product_id for row in Shopcart.read_all(100)), [232, 233])
+        rows = Shopcart.read_cart(123, 100)
+        self.assertEqual([tuple(row) for row in rows], [(123, 233, "a", 102.1, 3)])
+        self.assertEqual(len(Shopcart.read_cart(123)), 2)
+        page = Shopcart.read_page(2, after=(121, 232))
+        self.assertEqual([(row.customer_id, row.product_id) for row in page], [(123, 231), (123, 233)])
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_find_page(self):
+        """ Find Shopcart items one keyset page at a time """
+        Shopcart(customer_id=123, product_id=231, product_name="a",product_price=10.1,quantity=1).create()
+        Shopcart(customer_id=123, product_id=233, product_name="a",product_price=102.1,quantity=1).create()
+        Shopcart(customer_id=121, product_id=232, product_name="b",product_price=106,quantity=2).create()
+        page = Shopcart.find_page(2)
+        self.assertEqual([(s.customer_id, s.product_id) for s in page], [(121, 232), (123, 231)])
+        page = Shopcart.find_page(2, after=(123, 231))
+        self.assertEqual([(s.customer_id, s.product_id) for s in page], [(123, 233)])
+        page = Shopcart.find_page(2, price_threshold=100)
+        self.assertEqual([(s.customer_id, s.product_id) for s in page], [(121, 232), (123, 233)])
+
+    def test_skip_schema_on_boot(self):
+        """ Boot without creating the schema when DB_CREATE_SCHEMA is off """
+        with patch.object(Shopcart, "create_schema") as create_schema:
+            with patch.dict(app.config, {"DB_CREATE_SCHEMA": False}):
+                Shopcart.init_db(app)
+            create_schema.assert_not_called()
+            Shopcart.init_db(app)
+            create_schema.assert_called_once_with()
+
+    def test_dispose_engine(self):
+        """ Give a forked worker a pool of its own """
+        if db.engine.url.database in (None, "", ":memory:"):
+            self.skipTest("an in-memory database lives in its one connection")
+        Shopcart(customer_id=123, product_id=231, product_name="a", product_price=10.1, quantity=1).create()
+        db.session.remove()
+        pool = db.engine.pool
+        dispose_engine()
+        self.assertIsNot(db.engine.pool, pool)
+        self.assertEqual(len(Shopcart.read_cart(123)), 1)
@@ -0,0 +1,75 @@
+"""
+Test cases for the connection pool settings and statistics
+
+"""
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from services import app
+from services.models import db
+from services.pool import InstrumentedQueuePool, engine_options, pool_stats
+
+
+######################################################################
+#  P O O L   T E S T   C A S E S
+######################################################################
+class TestPool(unittest.TestCase):
+    """ Test Cases for the connection pool """
+
+    def setUp(self):
+        """ This runs before each test """
+        handle, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.engine = create_engine(
+            "sqlite:///" + self.path, poolclass=InstrumentedQueuePool,
+            pool_size=1, max_overflow=0, pool_timeout=0.01
+        )
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def test_checkout_statistics(self):
+        """ Count checkouts, checked out connections and timeouts """
+        connection = self.engine.connect()
+        stats = pool_stats(self.engine.pool)
+        self.assertEqual(stats["checked_out"], 1)
+        self.assertEqual(stats["checkouts"], 1)
+        self.assertRaises(PoolTimeoutError, self.engine.connect)
+        stats = pool_stats(self.engine.pool)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertGreaterEqual(stats["wait_time_max"], 0.01)
+        connection.close()
+        self.assertEqual(pool_stats(self.engine.pool)["checked_in"], 1)
+
+    def test_engine_options(self):
+        """ Size the pool of server databases only """
+        config = {
+            "SQLALCHEMY_DATABASE_URI": "postgres://localhost/shopcarts",
+            "DB_POOL_SIZE": 20, "DB_MAX_OVERFLOW": 5, "DB_POOL_RECYCLE": 300,
+            "DB_POOL_TIMEOUT": 2.5, "DB_POOL_PRE_PING": True,
+        }
+        options = engine_options(config)
+        self.assertEqual(options["pool_size"], 20)
+        self.assertEqual(options["max_overflow"], 5)
+        self.assertIs(options["poolclass"], InstrumentedQueuePool)
+        config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.assertEqual(engine_options(config), {"pool_pre_ping": True})
+        self.assertIs(engine_options(config, "postgres://replica/shopcarts")["poolclass"], InstrumentedQueuePool)
+
+    def test_pool_of_each_bind(self):
+        """ Size the pool of every bind by its own database """
+        config = dict(app.config, SQLALCHEMY_DATABASE_URI="sqlite://")
+        with patch.dict(app.config, config):
+            options = {}
+            db.apply_driver_hacks(app, make_url("postgresql://replica/shopcarts"), options)
+            self.assertIs(options["poolclass"], InstrumentedQueuePool)
+            self.assertEqual(options["pool_size"], app.config["DB_POOL_SIZE"])
+            options = {}
+            db.apply_driver_hacks(app, make_url("sqlite://"), options)
+            self.assertNotIn("pool_size", options)
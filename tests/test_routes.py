@@ -6,11 +6,15 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import json
 import logging
+from datetime import datetime, timedelta
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
+from sqlalchemy.exc import DBAPIError
 from services import status  # HTTP Status Codes
-from services.models import db,DataValidationError
+from services.models import db,DataValidationError,IdempotencyKey,cart_cache,quantity_buffer,Shopcart
+from services.idempotency import request_fingerprint
 from services.routes import app, init_db
 from .factories import ShopcartFactory
 
@@ -132,6 +136,70 @@ class TestShopcartServer(TestCase):
                             json=test_shopcart.serialize(), content_type="application/json")
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_add_products_batch(self):
+        """Add a batch of Products and report the ones that already exist"""
+        existing = self._create_shopcart(1)[0]
+        batch = [existing.serialize()]
+        for product_id in (1, 2, 2):
+            item = existing.serialize()
+            item["product_id"] = product_id
+            batch.append(item)
+        resp = self.app.post("{0}/{1}/products/".format(BASE_URL, existing.customer_id),
+                             json=batch, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual([item["product_id"] for item in data["created"]], [1, 2])
+        self.assertEqual([item["product_id"] for item in data["conflicts"]], [existing.product_id, 2])
+        resp = self.app.get("{0}/{1}".format(BASE_URL, existing.customer_id))
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_add_products_batch_with_bad_data(self):
+        """Add a batch of Products with an invalid item"""
+        test_shopcart = ShopcartFactory()
+        bad_item = test_shopcart.serialize()
+        del bad_item["product_name"]
+        resp = self.app.post("{0}/{1}/products/".format(BASE_URL, test_shopcart.customer_id),
+                             json=[test_shopcart.serialize(), bad_item], content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("{0}/{1}/products/".format(BASE_URL, test_shopcart.customer_id),
+                             json=[], content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("{0}/{1}".format(BASE_URL, test_shopcart.customer_id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_add_products_batch_for_other_customer(self):
+        """Add a batch of Products that belong to another customer"""
+        test_shopcart = ShopcartFactory()
+        other_item = test_shopcart.serialize()
+        other_item["customer_id"] = test_shopcart.customer_id + 1
+        other_item["product_id"] = test_shopcart.product_id + 1
+        resp = self.app.post("{0}/{1}/products/".format(BASE_URL, test_shopcart.customer_id),
+                             json=[test_shopcart.serialize(), other_item], content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for customer_id in (test_shopcart.customer_id, other_item["customer_id"]):
+            resp = self.app.get("{0}/{1}".format(BASE_URL, customer_id))
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_add_product_with_fraction_of_cent(self):
+        """Add a Product whose price has more than two decimals"""
+        test_shopcart = ShopcartFactory()
+        item = dict(test_shopcart.serialize(), product_price=9.999)
+        resp = self.app.post("{0}/{1}/products/".format(BASE_URL, test_shopcart.customer_id),
+                             json=item, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_add_same_product_with_merge(self):
+        """Add a Product that already exists in the shopcart with merge"""
+        test_shopcart = ShopcartFactory()
+        url = "{0}/{1}/products/?merge=true".format(BASE_URL, test_shopcart.customer_id)
+        resp = self.app.post(url, json=test_shopcart.serialize(), content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.headers["X-Upsert-Result"], "inserted")
+        resp = self.app.post(url, json=test_shopcart.serialize(), content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["X-Upsert-Result"], "merged")
+        self.assertEqual(resp.get_json()["quantity"], 2 * test_shopcart.quantity)
+
     def test_update_shopcart(self):
         """Update an existing shopcart"""
         # create a shopcart to update
@@ -154,6 +222,28 @@ class TestShopcartServer(TestCase):
         updated_shopcart = resp.get_json()
         self.assertEqual(updated_shopcart["quantity"], 3)
 
+    def test_adjust_product_quantity(self):
+        """Add to and remove from the quantity of a Product"""
+        test_shopcart = self._create_shopcart(1)[0]
+        url = "{0}/{1}/products/{2}".format(BASE_URL, test_shopcart.customer_id, test_shopcart.product_id)
+        resp = self.app.patch(url, json={"delta": 2}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["quantity"], test_shopcart.quantity + 2)
+        resp = self.app.patch(url, json={"delta": -(test_shopcart.quantity + 2)}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["quantity"], 0)
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.patch(url, json={"delta": 1}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_adjust_product_quantity_with_bad_data(self):
+        """Change the quantity of a Product with a bad delta"""
+        test_shopcart = self._create_shopcart(1)[0]
+        url = "{0}/{1}/products/{2}".format(BASE_URL, test_shopcart.customer_id, test_shopcart.product_id)
+        resp = self.app.patch(url, json={"delta": "a"}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_list_shopcarts(self):
         created_data = self._create_shopcart(5)
         resp = self.app.get(BASE_URL)
@@ -161,6 +251,47 @@ class TestShopcartServer(TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), len(created_data))
 
+    def test_list_shopcarts_by_page(self):
+        """List shopcarts one keyset page at a time"""
+        created_data = self._create_shopcart(15)
+        keys = []
+        url = "{0}?limit={1}".format(BASE_URL, 2)
+        while url:
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            self.assertLessEqual(len(data), 2)
+            keys.extend((item["customer_id"], item["product_id"]) for item in data)
+            cursor = resp.headers.get("X-Next-Cursor")
+            url = "{0}?limit={1}&after={2}".format(BASE_URL, 2, cursor) if cursor else None
+        self.assertEqual(keys, sorted((s.customer_id, s.product_id) for s in created_data))
+
+    def test_list_shopcarts_by_page_and_price(self):
+        """List shopcarts above a price one keyset page at a time"""
+        created_data = self._create_shopcart(15)
+        expected = [s for s in created_data if s.product_price >= 100]
+        resp = self.app.get("{0}?price={1}&limit={2}".format(BASE_URL, 100, len(created_data)))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), len(expected))
+        self.assertNotIn("X-Next-Cursor", resp.headers)
+
+    def test_list_shopcarts_bad_cursor(self):
+        """List shopcarts with a malformed cursor"""
+        resp = self.app.get("{0}?limit=2&after=abc".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_shopcarts(self):
+        """Export all shopcarts as newline-delimited JSON"""
+        created_data = self._create_shopcart(15)
+        with patch.dict(app.config, {"EXPORT_BATCH_SIZE": 4}):
+            resp = self.app.get("{0}/export".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), len(created_data))
+        keys = {(item["customer_id"], item["product_id"]) for item in map(json.loads, lines)}
+        self.assertEqual(keys, {(s.customer_id, s.product_id) for s in created_data})
+
     def test_read_shopcart(self):
         """Read an existing shopcart"""
         test_shopcart = self._create_shopcart(1)[0]
@@ -239,6 +370,215 @@ class TestShopcartServer(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_read_shopcart_through_cache(self):
+        """Read a shopcart through the cart cache and invalidate it on writes"""
+        cart_cache.configure(True, 10, 60)
+        self.addCleanup(cart_cache.configure, False, 10, 60)
+        test_shopcart = self._create_shopcart(1)[0]
+        url = "{0}/{1}".format(BASE_URL, test_shopcart.customer_id)
+        self.assertEqual(len(self.app.get(url).get_json()), 1)
+        self.assertEqual(len(self.app.get(url).get_json()), 1)
+        resp = self.app.get("{0}/products/{1}".format(url, test_shopcart.product_id))
+        self.assertEqual(resp.get_json()["quantity"], test_shopcart.quantity)
+        # each read looks up the version of the shopcart and then its items
+        resp = self.app.get("/api/stats/cache")
+        self.assertEqual(resp.get_json()["hits"], 4)
+        self.assertEqual(resp.get_json()["misses"], 2)
+        # a new product invalidates the cached shopcart
+        new_product = test_shopcart.serialize()
+        new_product["product_id"] += 1
+        resp = self.app.post("{0}/products/".format(url), json=new_product, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(self.app.get(url).get_json()), 2)
+        resp = self.app.put("{0}/checkout".format(url))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cache_with_leading_zeros(self):
+        """Invalidate a shopcart that was read with leading zeros in its customer_id"""
+        cart_cache.configure(True, 10, 60)
+        self.addCleanup(cart_cache.configure, False, 10, 60)
+        test_shopcart = self._create_shopcart(1)[0]
+        url = "{0}/00{1}".format(BASE_URL, test_shopcart.customer_id)
+        self.assertEqual(len(self.app.get(url).get_json()), 1)
+        resp = self.app.put("{0}/{1}/checkout".format(BASE_URL, test_shopcart.customer_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_write_behind_with_bad_customer_id(self):
+        """Answer requests for a customer_id that is not a number while quantities are buffered"""
+        quantity_buffer.configure(True, 3600, 100)
+        self.addCleanup(quantity_buffer.configure, False, 0.5, 1000)
+        test_shopcart = self._create_shopcart(1)[0]
+        url = "{0}/{1}/products/{2}".format(BASE_URL, test_shopcart.customer_id, test_shopcart.product_id)
+        self.app.patch(url, json={"delta": 1}, content_type="application/json")
+        self.assertEqual(quantity_buffer.stats()["pending"], 1)
+        resp = self.app.put("{0}/abc/products/1".format(BASE_URL), json=test_shopcart.serialize())
+        self.assertLess(resp.status_code, 500)
+        resp = self.app.patch("{0}/abc/products/1".format(BASE_URL), json={"delta": 1})
+        self.assertLess(resp.status_code, 500)
+        self.assertLess(self.app.get("{0}/abc/summary".format(BASE_URL)).status_code, 500)
+        self.assertLess(self.app.delete("{0}/abc".format(BASE_URL)).status_code, 500)
+        self.assertEqual(quantity_buffer.flush(), 1)
+
+    def test_write_behind_quantities(self):
+        """Buffer quantity changes and read them back before they are written"""
+        quantity_buffer.configure(True, 3600, 100)
+        self.addCleanup(quantity_buffer.configure, False, 0.5, 1000)
+        test_shopcart = self._create_shopcart(1)[0]
+        customer_id, product_id = test_shopcart.customer_id, test_shopcart.product_id
+        url = "{0}/{1}/products/{2}".format(BASE_URL, customer_id, product_id)
+        stored = lambda: Shopcart.read_cart(customer_id)[0].quantity
+        etag = self.app.get(url).headers["ETag"]
+        for _ in range(2):
+            resp = self.app.patch(url, json={"delta": 2}, content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["quantity"], test_shopcart.quantity + 4)
+        self.assertEqual(stored(), test_shopcart.quantity)
+        # this worker reads its own writes, and they change the ETag
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["quantity"], test_shopcart.quantity + 4)
+        cart = self.app.get("{0}/{1}".format(BASE_URL, customer_id)).get_json()
+        self.assertEqual(cart[0]["quantity"], test_shopcart.quantity + 4)
+        # an update of the quantity only is buffered too
+        update = dict(test_shopcart.serialize(), quantity=7)
+        resp = self.app.put(url, json=update, content_type="application/json")
+        self.assertEqual(resp.get_json()["quantity"], 7)
+        self.assertEqual(stored(), test_shopcart.quantity)
+        self.assertEqual(quantity_buffer.flush(), 1)
+        self.assertEqual(stored(), 7)
+        # removing the product is written right away
+        resp = self.app.patch(url, json={"delta": -7}, content_type="application/json")
+        self.assertEqual(resp.get_json()["quantity"], 0)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get("/api/stats/write-behind")
+        self.assertEqual(resp.get_json()["pending"], 0)
+
+    def test_read_shopcart_with_etag(self):
+        """Read a shopcart again with the ETag of the first read"""
+        test_shopcart = self._create_shopcart(1)[0]
+        url = "{0}/{1}".format(BASE_URL, test_shopcart.customer_id)
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+        self.assertEqual(resp.headers["ETag"], etag)
+        # another query of the same shopcart has its own ETag
+        resp = self.app.get(url + "?price=0", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # any change gives the shopcart a new ETag
+        resp = self.app.patch("{0}/products/{1}".format(url, test_shopcart.product_id),
+                              json={"delta": 1}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_read_product_with_etag(self):
+        """Read a product again with the ETag of the first read"""
+        test_shopcart = self._create_shopcart(1)[0]
+        url = "{0}/{1}/products/{2}".format(BASE_URL, test_shopcart.customer_id, test_shopcart.product_id)
+        etag = self.app.get(url).headers["ETag"]
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.app.patch(url, json={"delta": 1}, content_type="application/json")
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_list_shopcarts_with_etag(self):
+        """List shopcarts again with the ETag of the first list"""
+        self._create_shopcart(5)
+        etag = self.app.get(BASE_URL).headers["ETag"]
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        item = self.app.get(BASE_URL).get_json()[0]
+        self.app.patch("{0}/{1}/products/{2}".format(BASE_URL, item["customer_id"], item["product_id"]),
+                       json={"delta": 1}, content_type="application/json")
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_read_shopcart_summary(self):
+        """Read the totals of a shopcart"""
+        test_shopcart = self._create_shopcart(15)
+        customer_id = test_shopcart[0].customer_id
+        items = [s for s in test_shopcart if s.customer_id == customer_id]
+        resp = self.app.get("{0}/{1}/summary".format(BASE_URL, customer_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["item_count"], len(items))
+        self.assertEqual(data["total_quantity"], sum(s.quantity for s in items))
+        self.assertAlmostEqual(data["total_value"], sum(s.product_price * s.quantity for s in items), places=2)
+        resp = self.app.get("{0}/0/summary".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_shopcart_summaries(self):
+        """Read the totals of several shopcarts"""
+        test_shopcart = self._create_shopcart(15)
+        customer_ids = sorted({s.customer_id for s in test_shopcart})
+        query = "&".join("customer_id={}".format(customer_id) for customer_id in customer_ids + [0])
+        resp = self.app.get("{0}/summary?{1}".format(BASE_URL, query))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([summary["customer_id"] for summary in data], customer_ids)
+        self.assertEqual(sum(summary["item_count"] for summary in data), len(test_shopcart))
+        resp = self.app.get("{0}/summary".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_pool_stats(self):
+        """Read the statistics of the connection pool"""
+        resp = self.app.get("/api/stats/pool")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.get_json())
+
+    def test_time_failed_statement(self):
+        """Forget the start of a statement that failed"""
+        with db.engine.connect() as connection:
+            self.assertRaises(DBAPIError, connection.execute, "SELECT * FROM no_such_table")
+            connection.execute("SELECT 1")
+            self.assertNotIn("query_start", connection.info)
+
+    def test_get_metrics(self):
+        """Read the Prometheus metrics"""
+        test_shopcart = self._create_shopcart(1)[0]
+        self.app.get("{0}/{1}".format(BASE_URL, test_shopcart.customer_id))
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        data = resp.get_data(as_text=True)
+        self.assertIn('shopcart_http_requests_total{method="get",resource="ShopcartResource",status="200"}', data)
+        self.assertIn('shopcart_http_requests_total{method="post",resource="ProductCollection",status="201"}', data)
+        self.assertIn('shopcart_http_request_duration_seconds_bucket{le="0.005",method="get",resource="ShopcartResource"}', data)
+        self.assertIn('shopcart_db_query_duration_seconds_count{statement="SELECT"}', data)
+
+    def test_query_budgets(self):
+        """Run no more SQL statements than each endpoint needs"""
+        item = ShopcartFactory().serialize()
+        cart_url = "{0}/{1}".format(BASE_URL, item["customer_id"])
+        product_url = "{0}/products/{1}".format(cart_url, item["product_id"])
+        batch = [dict(item, product_id=product_id) for product_id in range(1, 41)]
+        budgets = [
+            ("post", cart_url + "/products/", item, 5),
+            ("post", cart_url + "/products/?merge=true", item, 3),
+            ("post", cart_url + "/products/", batch, 3),
+            ("get", cart_url, None, 2),
+            ("get", product_url, None, 2),
+            ("put", product_url, item, 4),
+            ("patch", product_url, {"delta": 1}, 3),
+            ("get", BASE_URL, None, 2),
+            ("get", BASE_URL + "?limit=10", None, 2),
+            ("get", cart_url + "/summary", None, 1),
+            ("delete", cart_url + "/products/1", None, 3),
+            ("put", cart_url + "/checkout", None, 3),
+            ("delete", cart_url, None, 2),
+        ]
+        for method, url, data, budget in budgets:
+            resp = getattr(self.app, method)(url, json=data)
+            self.assertLess(resp.status_code, 400, "{} {}".format(method, url))
+            self.assertLessEqual(int(resp.headers["X-Query-Count"]), budget, "{} {}".format(method, url))
+            self.assertIn("db;dur=", resp.headers["Server-Timing"])
+
     def test_get_shopcart_not_found(self):
         """Get a Shopcart thats not found"""
         resp = self.app.get("{}/0".format(BASE_URL))
@@ -249,7 +589,7 @@ class TestShopcartServer(TestCase):
         resp = self.app.put(BASE_URL)
         self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
 
-    @patch('services.routes.Shopcart.find_by_customer_id')
+    @patch('services.routes.Shopcart.read_cart')
     def test_bad_request(self, bad_request_mock):
         """ Test a Bad Request error from Find By customer_id """
         bad_request_mock.side_effect = DataValidationError()
@@ -308,6 +648,105 @@ class TestShopcartServer(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_checkout_customer_with_many_products(self):
+        """Checkout a customer with several products in the shopcart"""
+        test_shopcart = self._create_shopcart(15)
+        customer_id = test_shopcart[0].customer_id
+        expected = sorted(s.product_id for s in test_shopcart if s.customer_id == customer_id)
+        resp = self.app.put("{0}/{1}/checkout".format(BASE_URL, customer_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(item["product_id"] for item in resp.get_json()), expected)
+        resp = self.app.get("{0}/{1}".format(BASE_URL, customer_id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_checkout_with_idempotency_key(self):
+        """Checkout a customer twice with the same Idempotency-Key"""
+        test_shopcart = self._create_shopcart(1)[0]
+        url = "{0}/{1}/checkout".format(BASE_URL, test_shopcart.customer_id)
+        resp = self.app.put(url, headers={"Idempotency-Key": "checkout-1"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Idempotent-Replayed"], "false")
+        retry = self.app.put(url, headers={"Idempotency-Key": "checkout-1"})
+        self.assertEqual(retry.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.get_json(), resp.get_json())
+        resp = self.app.put(url, headers={"Idempotency-Key": "checkout-2"})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_checkout_with_expired_idempotency_key(self):
+        """Checkout again with an Idempotency-Key that expired"""
+        test_shopcart = self._create_shopcart(1)[0]
+        url = "{0}/{1}/checkout".format(BASE_URL, test_shopcart.customer_id)
+        resp = self.app.put(url, headers={"Idempotency-Key": "checkout-1"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        IdempotencyKey.query.filter_by(key="checkout-1").update(
+            {"created_at": datetime.utcnow() - timedelta(seconds=IdempotencyKey.ttl + 1)}
+        )
+        db.session.commit()
+        self.app.post("{0}/{1}/products/".format(BASE_URL, test_shopcart.customer_id), json=test_shopcart.serialize())
+        resp = self.app.put(url, headers={"Idempotency-Key": "checkout-1"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Idempotent-Replayed"], "false")
+        self.assertEqual(resp.get_json()[0]["product_id"], test_shopcart.product_id)
+
+    def test_retry_with_idempotency_key(self):
+        """Retry adding and changing a product with the same Idempotency-Key"""
+        test_shopcart = ShopcartFactory()
+        url = "{0}/{1}/products/".format(BASE_URL, test_shopcart.customer_id)
+        headers = {"Idempotency-Key": "add-1"}
+        resp = self.app.post(url, json=test_shopcart.serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.headers["Idempotent-Replayed"], "false")
+        retry = self.app.post(url, json=test_shopcart.serialize(), headers=headers)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.get_json(), resp.get_json())
+        # the same key with another request is refused
+        other = dict(test_shopcart.serialize(), quantity=test_shopcart.quantity + 1)
+        resp = self.app.post(url, json=other, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        # a retried delta is applied once
+        product_url = "{0}{1}".format(url, test_shopcart.product_id)
+        for _ in range(2):
+            resp = self.app.patch(product_url, json={"delta": 1}, headers={"Idempotency-Key": "patch-1"})
+            self.assertEqual(resp.get_json()["quantity"], test_shopcart.quantity + 1)
+        self.assertEqual(self.app.get(product_url).get_json()["quantity"], test_shopcart.quantity + 1)
+        # a failed request gives its key up
+        resp = self.app.put("{0}{1}".format(url, 0), json=test_shopcart.serialize(), headers={"Idempotency-Key": "put-1"})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.put(product_url, json=test_shopcart.serialize(), headers={"Idempotency-Key": "put-1"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_retry_claim_never_completed(self):
+        """Retry a request whose first attempt died before it completed"""
+        test_shopcart = ShopcartFactory()
+        url = "{0}/{1}/products/".format(BASE_URL, test_shopcart.customer_id)
+        headers = {"Idempotency-Key": "add-1"}
+        # the first attempt claimed the key and its worker was killed
+        with app.test_request_context(url, method="POST", json=test_shopcart.serialize(), headers=headers):
+            IdempotencyKey.reserve("add-1", test_shopcart.customer_id, request_fingerprint())
+        db.session.info.pop(IdempotencyKey.DEFERRED)
+        resp = self.app.post(url, json=test_shopcart.serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        IdempotencyKey.query.filter_by(key="add-1").update(
+            {"claimed_at": datetime.utcnow() - timedelta(seconds=IdempotencyKey.lease + 1)}
+        )
+        db.session.commit()
+        resp = self.app.post(url, json=test_shopcart.serialize(), headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.headers["Idempotent-Replayed"], "false")
+        retry = self.app.post(url, json=test_shopcart.serialize(), headers=headers)
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.get_json(), resp.get_json())
+
+    def test_db_init(self):
+        """ Create the schema with the db-init command """
+        db.drop_all()
+        result = app.test_cli_runner().invoke(args=["db-init"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("up to date", result.output)
+        self.assertEqual(len(Shopcart.read_all()), 0)
+
     def test_checkout_not_exist_customer(self):
         """checkout a nonexisting customer"""
         resp = self.app.put(
@@ -0,0 +1,66 @@
+"""
+Test cases for the fast JSON encoding
+
+"""
+import json
+import unittest
+from flask_restx import marshal
+from services import serializers
+from services.models import READ_COLUMNS
+from services.routes import shopcart_model
+from services.serializers import RowEncoder
+from tests.factories import ShopcartFactory
+
+
+######################################################################
+#  R O W   E N C O D E R   T E S T   C A S E S
+######################################################################
+class TestRowEncoder(unittest.TestCase):
+    """ Test Cases for the RowEncoder """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.encoder = RowEncoder(shopcart_model)
+
+    def tearDown(self):
+        """ This runs after each test """
+        serializers.configure()
+
+    def test_same_as_marshal(self):
+        """ Encode rows exactly like marshal() """
+        shopcarts = ShopcartFactory.build_batch(5)
+        shopcarts[0].product_price = 30
+        shopcarts[1].product_name = None
+        expected = [dict(marshal(shopcart.serialize(), shopcart_model)) for shopcart in shopcarts]
+        self.assertEqual(self.encoder.dicts(self.encoder.rows(shopcarts)), expected)
+        self.assertIsInstance(self.encoder.dicts(self.encoder.rows(shopcarts))[0]["product_price"], float)
+
+    def test_encode_tuples(self):
+        """ Encode rows given as tuples in the order of the model """
+        data = json.loads(serializers.dumps(self.encoder.dicts([(1, 2, "pen", 3, 4)])))
+        self.assertEqual(data, [{
+            "customer_id": 1, "product_id": 2, "product_name": "pen", "product_price": 3.0, "quantity": 4
+        }])
+
+    def test_rows_in_model_order(self):
+        """ Read rows with the columns in the order of the model """
+        self.assertEqual(tuple(self.encoder.keys), READ_COLUMNS)
+
+    def test_json_backends(self):
+        """ Dump the same JSON with every backend """
+        data = self.encoder.dicts([(1, 2, "café", 3.5, 4)])
+        serializers.configure("json")
+        with_json = serializers.dumps(data)
+        serializers.configure("auto")
+        self.assertEqual(json.loads(serializers.dumps(data)), json.loads(with_json))
+
+    def test_unknown_backend(self):
+        """ Refuse a JSON backend that does not exist """
+        self.assertRaises(ValueError, serializers.configure, "pickle")
+
+    def test_response(self):
+        """ Return the encoded rows as a JSON response """
+        resp = serializers.json_response(self.encoder.dicts([(1, 2, "pen", 3, 4)]), 200, {"ETag": '"x"'})
+        self.assertEqual(resp.mimetype, "application/json")
+        self.assertEqual(resp.headers["ETag"], '"x"')
+        self.assertEqual(resp.get_json()[0]["product_name"], "pen")
@@ -0,0 +1,116 @@
+"""
+Test cases for the write-behind buffer of quantity changes
+
+"""
+import threading
+import unittest
+from services.writebehind import QuantityBuffer
+
+
+######################################################################
+#  Q U A N T I T Y   B U F F E R   T E S T   C A S E S
+######################################################################
+class TestQuantityBuffer(unittest.TestCase):
+    """ Test Cases for the QuantityBuffer """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.written = []
+        self.buffer = QuantityBuffer(enabled=True, interval=3600, max_pending=3)
+        self.buffer.configure(True, 3600, 3, apply=self.written.append)
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.buffer.close()
+
+    def test_changes_are_merged(self):
+        """ Merge the changes buffered for the same item """
+        self.buffer.add(1, 1, 2)
+        self.buffer.add("1", "1", 3)
+        self.buffer.set(1, 2, 5)
+        self.buffer.add(1, 2, -1)
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(sorted(self.written[0]), [(1, 1, None, 5), (1, 2, 4, 0)])
+
+    def test_overlay(self):
+        """ Apply pending changes to items without changing them """
+        item = {"customer_id": 1, "product_id": 1, "quantity": 2}
+        self.assertIs(self.buffer.overlay_item(item), item)
+        self.buffer.add(1, 1, 3)
+        self.assertEqual(self.buffer.overlay([item])[0]["quantity"], 5)
+        self.buffer.set(1, 1, 9)
+        self.assertEqual(self.buffer.overlay_item(item)["quantity"], 9)
+        self.assertEqual(item["quantity"], 2)
+
+    def test_flush_one_customer(self):
+        """ Write the changes of a single customer """
+        self.buffer.add(1, 1, 1)
+        self.buffer.add(2, 1, 1)
+        sequence = self.buffer.sequence(2)
+        self.assertEqual(self.buffer.flush(1), 1)
+        self.assertEqual(self.written, [[(1, 1, None, 1)]])
+        self.assertEqual(self.buffer.sequence(1), 0)
+        self.assertEqual(self.buffer.sequence(2), sequence)
+        self.assertEqual(self.buffer.stats()["pending"], 1)
+
+    def test_customers_written(self):
+        """ Tell which customers had their changes written """
+        customers = []
+        self.buffer.configure(True, 3600, 100, on_written=customers.append)
+        self.buffer.add(1, 1, 1)
+        self.buffer.add(1, 2, 1)
+        self.buffer.add(2, 1, 1)
+        self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(sorted(customers), [1, 2])
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(sorted(customers), [1, 2])
+
+    def test_customer_that_is_not_a_number(self):
+        """ Flush nothing for a customer_id that is not a number """
+        self.buffer.add(1, 1, 2)
+        self.assertEqual(self.buffer.flush("abc"), 0)
+        self.assertEqual(self.buffer.sequence("abc"), 0)
+        self.assertEqual(self.buffer.flush("1"), 1)
+
+    def test_flush_when_full(self):
+        """ Write the changes as soon as max_pending items wait """
+        for product_id in range(3):
+            self.buffer.add(1, product_id, 1)
+        self.assertEqual(len(self.written), 1)
+        self.assertEqual(self.buffer.stats()["pending"], 0)
+
+    def test_failed_flush_keeps_changes(self):
+        """ Keep the changes that could not be written """
+        def fail(changes):
+            raise RuntimeError("database is down")
+        self.buffer.configure(True, 3600, 3, apply=fail)
+        self.buffer.set(1, 1, 4)
+        self.assertRaises(RuntimeError, self.buffer.flush)
+        self.assertEqual(self.buffer.overlay_item({"customer_id": 1, "product_id": 1, "quantity": 0})["quantity"], 4)
+        self.buffer.add(1, 1, 1)
+        self.buffer.configure(True, 3600, 3, apply=self.written.append)
+        self.buffer.flush()
+        self.assertEqual(self.written, [[(1, 1, 5, 0)]])
+
+    def test_overlay_while_flushing(self):
+        """ Overlay the changes that are being written until they are committed """
+        started, proceed = threading.Event(), threading.Event()
+        def apply(changes):
+            started.set()
+            proceed.wait(5)
+            self.written.append(changes)
+        self.buffer.configure(True, 3600, 3, apply=apply)
+        item = {"customer_id": 1, "product_id": 1, "quantity": 2}
+        self.buffer.add(1, 1, 3)
+        sequence = self.buffer.sequence(1)
+        flush = threading.Thread(target=self.buffer.flush)
+        flush.start()
+        self.assertTrue(started.wait(5))
+        self.assertEqual(self.buffer.overlay_item(item)["quantity"], 5)
+        self.buffer.add(1, 1, 1)
+        self.assertEqual(self.buffer.overlay([item])[0]["quantity"], 6)
+        self.assertNotEqual(self.buffer.sequence(1), sequence)
+        proceed.set()
+        flush.join(5)
+        self.assertEqual(self.written, [[(1, 1, None, 3)]])
+        self.assertEqual(self.buffer.overlay_item(dict(item, quantity=5))["quantity"], 6)